@@ -11,24 +11,35 @@ import re
 import sys
 import struct
 import json
+import zlib
+import base64
+import hashlib
+import functools
 import requests
 import argparse
 import getpass
 import threading
-import werkzeug.serving
+import multiprocessing
+import Queue
+import random
+from multiprocessing.pool import ThreadPool
 import pokemon_pb2
 import time
-from google.protobuf.internal import encoder
 from google.protobuf.message import DecodeError
 from s2sphere import *
 from datetime import datetime
+from collections import OrderedDict
 from geopy.geocoders import GoogleV3
 from gpsoauth import perform_master_login, perform_oauth
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from requests.adapters import ConnectionError
+from requests.adapters import ConnectionError, HTTPAdapter
+from requests.exceptions import Timeout
 from requests.models import InvalidURL
 from transform import *
+from store import (SightingStore, SqliteBackend, CLUSTER_LEVEL, in_bounds,
+                   replace_file)
+from scheduler import SpawnSchedule
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -47,13 +58,35 @@ SERVICE = credentials.get('service', None)
 CLIENT_SIG = credentials.get('client_sig', None)
 GOOGLEMAPS_KEY = credentials.get('gmaps_key', None)
 
-SESSION = requests.session()
-SESSION.headers.update({'User-Agent': 'Niantic App'})
-SESSION.verify = False
+RPC_TIMEOUT = 10  # seconds
+
+# credential lifetimes, for when the server does not tell
+PTC_TOKEN_LIFETIME = 7200  # seconds
+GOOGLE_TOKEN_LIFETIME = 3600  # seconds
+AUTH_TICKET_LIFETIME = 1800  # seconds
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry credentials are renewed
+TOKEN_RETRY_DELAY = 30  # seconds between failed renewals
+
+
+def create_session(pool_size=10):
+    """
+    HTTP session keeping up to pool_size connections alive per host. Threads
+    sending through it beyond that wait for a free connection, rather than
+    opening one that would be thrown away after a single request.
+    """
+
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                          pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': 'Niantic App'})
+    session.verify = False
+    return session
+
+
+SESSION = create_session()
 
-global_password = None
-global_token = None
-access_token = None
 DEBUG = True
 VERBOSE_DEBUG = False  # if you want to write raw request/response to the console
 COORDS_LATITUDE = 0
@@ -66,9 +99,7 @@ NEXT_LONG = 0
 auto_refresh = 0
 default_step = 0.001
 api_endpoint = None
-pokemons = {}
-gyms = {}
-pokestops = {}
+store = SightingStore()
 numbertoteam = {  # At least I'm pretty sure that's it. I could be wrong and then I'd be displaying the wrong owner team of gyms.
     0: 'Gym',
     1: 'Mystic',
@@ -77,27 +108,215 @@ numbertoteam = {  # At least I'm pretty sure that's it. I could be wrong and the
 }
 origin_lat, origin_lon = None, None
 is_ampm_clock = False
+locale = 'en'
+pokemon_names = {}
+scan_workers = []
+scan_plan = None
+neighbor_cache = {}
+
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket limiting the rate of API requests. One bucket can
+    be shared by every thread sending requests on behalf of the same budget.
+    :param rate: tokens refilled per second
+    :param burst: maximum number of tokens the bucket holds
+    """
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = float(burst)
+            self.tokens = min(self.tokens, self.burst)
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, sleeping only as long as the budget requires
+        :param tokens: number of tokens to take
+        :return: seconds spent waiting
+        """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens are reserved before sleeping so that concurrent callers
+            # queue up behind each other instead of all waking at once
+            self.tokens -= tokens
+            wait = max(0, -self.tokens / self.rate)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RetryPolicy(object):
+    """
+    Thread-safe retry policy for API requests: exponential backoff with full
+    jitter, bounded by a number of attempts and a deadline, and a circuit
+    breaker per endpoint. Once an endpoint has failed breaker_threshold times
+    in a row its circuit opens and callers wait, instead of sending, until a
+    single trial request every breaker_timeout seconds gets through again.
+    :param base_delay: seconds to wait after the first failure, doubled after
+    each further one
+    :param max_delay: longest wait between two attempts
+    :param max_attempts: attempts before giving up, None for no limit
+    :param deadline: seconds before giving up, None for no limit
+    """
+
+    def __init__(self, base_delay=0.5, max_delay=30.0, max_attempts=8,
+                 deadline=120.0, breaker_threshold=5, breaker_timeout=30.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.lock = threading.Lock()
+        self.failures = {}  # endpoint: consecutive failures
+        self.opened = {}  # endpoint: time its circuit was last (re)opened
+        self.counters = dict.fromkeys(
+            ['attempts', 'retries', 'gave_up', 'circuits_opened',
+             'circuit_waits'], 0)
+
+    def get_deadline(self):
+        """ Absolute time a call started now has to give up at """
+        if self.deadline is None:
+            return None
+        return time.time() + self.deadline
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _circuit_wait(self, endpoint):
+        """
+        Seconds until the endpoint's circuit lets a request through. The
+        caller that finds it half-open gets 0 and re-opens it for the others.
+        """
+
+        with self.lock:
+            if self.failures.get(endpoint, 0) < self.breaker_threshold:
+                return 0
+            now = time.time()
+            wait = self.opened[endpoint] + self.breaker_timeout - now
+            if wait <= 0:
+                self.opened[endpoint] = now
+                return 0
+            return wait
+
+    def _record(self, endpoint, ok):
+        with self.lock:
+            if ok:
+                self.failures.pop(endpoint, None)
+                self.opened.pop(endpoint, None)
+                return
+            failures = self.failures.get(endpoint, 0) + 1
+            self.failures[endpoint] = failures
+            if failures == self.breaker_threshold:
+                self.opened[endpoint] = time.time()
+                self.counters['circuits_opened'] += 1
+                debug('RetryPolicy: circuit for {} opened'.format(endpoint))
+
+    def call(self, endpoint, request, accept=bool, deadline=None):
+        """
+        Call request until accept holds for its result
+        :param endpoint: URL the request is sent to, keying its circuit
+        :param request: function sending the request
+        :param accept: function telling whether a result is usable
+        :param deadline: absolute time to give up at, from get_deadline by
+        default; calls made from within request should share it
+        :return: the first accepted result, None if the policy gave up
+        """
+
+        if deadline is None:
+            deadline = self.get_deadline()
+        attempt = 0
+        while True:
+            wait = self._circuit_wait(endpoint)
+            if wait:
+                if deadline is not None and time.time() + wait > deadline:
+                    break
+                self._count('circuit_waits')
+                time.sleep(wait)
+                continue
+
+            self._count('attempts')
+            result = None
+            try:
+                result = request()
+            except (InvalidURL, ConnectionError, Timeout, DecodeError), e:
+                debug('RetryPolicy: request error ({})'.format(str(e)))
+            if result is not None and accept(result):
+                self._record(endpoint, True)
+                return result
+            self._record(endpoint, False)
+
+            attempt += 1
+            if self.max_attempts is not None and attempt >= self.max_attempts:
+                break
+            delay = self.get_delay(attempt - 1)
+            if deadline is not None and time.time() + delay > deadline:
+                break
+            self._count('retries')
+            time.sleep(delay)
+
+        self._count('gave_up')
+        debug('RetryPolicy: giving up on {} after {} attempts'.format(
+            endpoint, attempt))
+        return None
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+RETRY_POLICY = RetryPolicy()
 
 # stuff for in-background search thread
 
-search_thread = None
+scan_service = None
+# S2 level of the cells the scan area is split by between processes
+SHARD_LEVEL = 14
+SCAN_IDLE_DELAY = 5  # seconds between looks for due steps when none are
 
-def memoize(obj):
-    cache = obj.cache = {}
+# server-sent event streams, each holds a request thread while open; past
+# max_stream_clients per process, maps poll instead
+MAX_STREAM_CLIENTS = 100
+STREAM_KEEPALIVE = 15  # seconds
+max_stream_clients = MAX_STREAM_CLIENTS
+stream_clients = 0
+stream_clients_lock = threading.Lock()
 
-    @functools.wraps(obj)
-    def memoizer(*args, **kwargs):
-        key = str(args) + str(kwargs)
-        if key not in cache:
-            cache[key] = obj(*args, **kwargs)
-        return cache[key]
-    return memoizer
+# bodies of conditional responses, by ETag
+RESPONSE_CACHE_SIZE = 64
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
 
 def parse_unicode(bytestring):
     decoded_string = bytestring.decode(sys.getfilesystemencoding())
     return decoded_string
 
 
+def parse_positive_float(string):
+    value = float(string)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(
+            '{} is not a positive number'.format(string))
+    return value
+
+
 def debug(message):
     if DEBUG:
         print '[-] {}'.format(message)
@@ -110,27 +329,168 @@ def time_left(ms):
     return (h, m, s)
 
 
-def encode(cellid):
-    output = []
-    encoder._VarintEncoder()(output.append, cellid)
-    return ''.join(output)
+def encode_varint(value, buf):
+    while value > 0x7f:
+        buf.append(0x80 | (value & 0x7f))
+        value >>= 7
+    buf.append(value)
+
+
+def getNeighbors(cell_id, count=10):
+    """
+    IDs of a cell and the count cells before and after it on the Hilbert curve.
+    Stepping to the next cell of the same level adds twice the lowest set bit,
+    so the walk is plain integer arithmetic.
+    :param cell_id: integer ID of the center cell
+    :return: sorted list of cell IDs
+    """
+
+    step = (cell_id & -cell_id) << 1
+    return sorted((cell_id + i * step) & 0xFFFFFFFFFFFFFFFF
+                  for i in range(-count, count + 1))
+
+
+def encode_neighbors(lat, lng):
+    """
+    Varint-encoded cell IDs around a location, as sent in MessageQuad.f1.
+    Results are cached per level-15 cell.
+    """
+
+    cell_id = CellId.from_lat_lng(LatLng.from_degrees(lat,
+                                                      lng)).parent(15).id()
+    cells = neighbor_cache.get(cell_id)
+    if cells is None:
+        buf = bytearray()
+        for neighbor in getNeighbors(cell_id):
+            encode_varint(neighbor, buf)
+        cells = neighbor_cache[cell_id] = str(buf)
+    return cells
+
+
+def get_spiral(lat, lng, steplimit):
+    """
+    Step locations of the spiral scan around an origin
+    :return: list of (lat, lng) tuples, innermost first
+    """
+
+    x = 0
+    y = 0
+    dx = 0
+    dy = -1
+    steplimit2 = steplimit**2
+    steps = []
+    (step_lat, step_lng) = (lat, lng)
+    for step in range(steplimit2):
+        # Scan location math
+        if -steplimit2 / 2 < x <= steplimit2 / 2 and -steplimit2 / 2 < y <= steplimit2 / 2:
+            (step_lat, step_lng) = (x * 0.0025 + lat, y * 0.0025 + lng)
+        if x == y or x < 0 and x == -y or x > 0 and x == 1 - y:
+            (dx, dy) = (-dy, dx)
+
+        (x, y) = (x + dx, y + dy)
+        steps.append((step_lat, step_lng))
+    return steps
+
+
+def get_shard_cell(location):
+    return CellId.from_lat_lng(LatLng.from_degrees(*location)).parent(
+        SHARD_LEVEL).id()
+
+
+def get_shard_cells(locations):
+    """
+    :return: IDs of the SHARD_LEVEL S2 cells the locations fall in, in S2
+             curve order
+    """
+
+    return sorted(set(get_shard_cell(location) for location in locations))
+
+
+def get_shard(locations, shard, shards):
+    """
+    Split spiral step locations between shards, by the SHARD_LEVEL S2 cells
+    they fall in. Each shard gets a run of cells consecutive along the S2
+    curve, so it covers a compact part of the area. There should be no more
+    shards than cells, or some get no locations at all.
+    :return: the locations of one shard, in spiral order
+    """
+
+    cells = get_shard_cells(locations)
+    mine = set(cells[shard * len(cells) // shards:
+                     (shard + 1) * len(cells) // shards])
+    return [location for location in locations
+            if get_shard_cell(location) in mine]
+
+
+class ScanStep(object):
+    """
+    A single spiral step: its level-15 parent cell, the locations heartbeats
+    are sent from (the step itself and the centers of the parent's children)
+    and the encoded neighbour cells shared by all of those heartbeats.
+    """
+
+    def __init__(self, index, lat, lng):
+        self.index = index
+        self.lat = lat
+        self.lng = lng
+        self.parent = CellId.from_lat_lng(LatLng.from_degrees(lat,
+                                                              lng)).parent(15)
+        self.children = list(self.parent.children())
+        self.locations = [(lat, lng)]
+        for child in self.children:
+            latlng = LatLng.from_point(Cell(child).get_center())
+            self.locations.append((latlng.lat().degrees, latlng.lng().degrees))
+        # children of the parent cell have the parent as level-15 cell too,
+        # so every heartbeat of the step asks for the same neighbourhood
+        self.cells = encode_neighbors(lat, lng)
+
+
+class ScanPlan(object):
+    """
+    All the steps of a spiral scan, computed once per (origin, step limit) and
+    reused for every scan cycle, along with the schedule telling which of them
+    are due.
+    """
+
+    def __init__(self, lat, lng, steplimit, shard=None):
+        self.origin = (lat, lng)
+        self.steplimit = steplimit
+        self.shard = shard
+        locations = get_spiral(lat, lng, steplimit)
+        if shard is not None:
+            locations = get_shard(locations, *shard)
+        self.steps = [ScanStep(i, step_lat, step_lng)
+                      for (i, (step_lat, step_lng)) in enumerate(locations)]
+        self.schedule = SpawnSchedule(len(self.steps))
+
+    def matches(self, lat, lng, steplimit, shard=None):
+        return (self.origin == (lat, lng) and self.steplimit == steplimit and
+                self.shard == shard)
+
+    def get_steps_in(self, bounds):
+        """
+        :return: indexes of the steps within (south, west, north, east) bounds
+        """
 
+        return [step.index for step in self.steps
+                if in_bounds(bounds, step.lat, step.lng)]
 
-def getNeighbors():
-    origin = CellId.from_lat_lng(LatLng.from_degrees(FLOAT_LAT,
-                                                     FLOAT_LONG)).parent(15)
-    walk = [origin.id()]
+    def get_nearest_step(self, lat, lng):
+        """
+        :return: index of the step closest to a location
+        """
 
-    # 10 before and 10 after
+        return min(self.steps, key=lambda step: (step.lat - lat)**2 +
+                   (step.lng - lng)**2).index
 
-    next = origin.next()
-    prev = origin.prev()
-    for i in range(10):
-        walk.append(prev.id())
-        walk.append(next.id())
-        next = next.next()
-        prev = prev.prev()
-    return walk
+
+def get_scan_plan(lat, lng, steplimit, shard=None):
+    global scan_plan
+    if scan_plan is None or not scan_plan.matches(lat, lng, steplimit, shard):
+        debug('get_scan_plan: computing {} steps around {}, {}'.format(
+            steplimit**2, lat, lng))
+        scan_plan = ScanPlan(lat, lng, steplimit, shard)
+    return scan_plan
 
 
 def f2i(float):
@@ -197,17 +557,18 @@ def get_location_coords():
 
 
 def retrying_api_req(service, api_endpoint, access_token, *args, **kwargs):
-    while True:
-        try:
-            response = api_req(service, api_endpoint, access_token, *args,
-                               **kwargs)
-            if response:
-                return response
-            debug('retrying_api_req: api_req returned None, retrying')
-        except (InvalidURL, ConnectionError, DecodeError), e:
-            debug('retrying_api_req: request error ({}), retrying'.format(
-                str(e)))
-        time.sleep(1)
+    """
+    api_req, retried by the policy given as retry= until the response passes
+    accept=. Callers check what they need through accept instead of retrying
+    around this, so a request is never retried at more than one level.
+    """
+    policy = kwargs.get('retry') or RETRY_POLICY
+    accept = kwargs.pop('accept', bool)
+    return policy.call(
+        api_endpoint,
+        lambda: api_req(service, api_endpoint, access_token, *args, **kwargs),
+        accept=accept,
+        deadline=kwargs.get('deadline'))
 
 
 def api_req(service, api_endpoint, access_token, *args, **kwargs):
@@ -216,8 +577,11 @@ def api_req(service, api_endpoint, access_token, *args, **kwargs):
 
     p_req.unknown1 = 2
 
-    (p_req.latitude, p_req.longitude, p_req.altitude) = \
-        get_location_coords()
+    if 'coords' in kwargs and kwargs['coords']:
+        (p_req.latitude, p_req.longitude, p_req.altitude) = kwargs['coords']
+    else:
+        (p_req.latitude, p_req.longitude, p_req.altitude) = \
+            get_location_coords()
 
     p_req.unknown12 = 989
 
@@ -235,7 +599,11 @@ def api_req(service, api_endpoint, access_token, *args, **kwargs):
 
     protobuf = p_req.SerializeToString()
 
-    r = SESSION.post(api_endpoint, data=protobuf, verify=False)
+    if 'limiter' in kwargs and kwargs['limiter']:
+        kwargs['limiter'].acquire()
+    session = kwargs.get('session') or SESSION
+    r = session.post(api_endpoint, data=protobuf, verify=False,
+                     timeout=kwargs.get('timeout') or RPC_TIMEOUT)
 
     p_ret = pokemon_pb2.ResponseEnvelop()
     p_ret.ParseFromString(r.content)
@@ -248,45 +616,27 @@ def api_req(service, api_endpoint, access_token, *args, **kwargs):
         print '''
 
 '''
-    time.sleep(0.51)
     return p_ret
 
 
-def get_api_endpoint(service, access_token, api=API_URL):
-    profile_response = None
-    while not profile_response:
-        profile_response = retrying_get_profile(service, access_token, api,
-                                                None)
-        if not hasattr(profile_response, 'api_url'):
-            debug(
-                'retrying_get_profile: get_profile returned no api_url, retrying')
-            profile_response = None
-            continue
-        if not len(profile_response.api_url):
-            debug(
-                'get_api_endpoint: retrying_get_profile returned no-len api_url, retrying')
-            profile_response = None
+def get_api_endpoint(service, access_token, api=API_URL, **kwargs):
+    profile_response = retrying_get_profile(
+        service, access_token, api, None,
+        accept=lambda response: (getattr(response, 'payload', None) and
+                                 len(getattr(response, 'api_url', ''))),
+        **kwargs)
+    if profile_response is None:
+        return None
 
     return 'https://%s/rpc' % profile_response.api_url
 
-def retrying_get_profile(service, access_token, api, useauth, *reqq):
-    profile_response = None
-    while not profile_response:
-        profile_response = get_profile(service, access_token, api, useauth,
-                                       *reqq)
-        if not hasattr(profile_response, 'payload'):
-            debug(
-                'retrying_get_profile: get_profile returned no payload, retrying')
-            profile_response = None
-            continue
-        if not profile_response.payload:
-            debug(
-                'retrying_get_profile: get_profile returned no-len payload, retrying')
-            profile_response = None
+def retrying_get_profile(service, access_token, api, useauth, *reqq,
+                         **kwargs):
+    kwargs.setdefault('accept',
+                      lambda response: getattr(response, 'payload', None))
+    return get_profile(service, access_token, api, useauth, *reqq, **kwargs)
 
-    return profile_response
-
-def get_profile(service, access_token, api, useauth, *reqq):
+def get_profile(service, access_token, api, useauth, *reqq, **kwargs):
     req = pokemon_pb2.RequestEnvelop()
     req1 = req.requests.add()
     req1.type = 2
@@ -312,9 +662,14 @@ def get_profile(service, access_token, api, useauth, *reqq):
     req5.type = 5
     if len(reqq) >= 5:
         req5.MergeFrom(reqq[4])
-    return retrying_api_req(service, api, access_token, req, useauth=useauth)
+    return retrying_api_req(service, api, access_token, req, useauth=useauth,
+                            **kwargs)
 
 def login_google(username, password):
+    """
+    :return: (access token, time it expires at), (None, None) on failure
+    """
+
     print '[!] Google login for: {}'.format(username)
     r1 = perform_master_login(username, password, ANDROID_ID)
     r2 = perform_oauth(username,
@@ -323,20 +678,27 @@ def login_google(username, password):
                        SERVICE,
                        APP,
                        CLIENT_SIG, )
-    return r2.get('Auth')
+    if not r2.get('Auth'):
+        return (None, None)
+    expiry = int(r2.get('Expiry', 0)) or time.time() + GOOGLE_TOKEN_LIFETIME
+    return (r2['Auth'], expiry)
+
+def login_ptc(username, password, session=SESSION):
+    """
+    :return: (access token, time it expires at), (None, None) on failure
+    """
 
-def login_ptc(username, password):
     print '[!] PTC login for: {}'.format(username)
     head = {'User-Agent': 'Niantic App'}
-    r = SESSION.get(LOGIN_URL, headers=head)
+    r = session.get(LOGIN_URL, headers=head)
     if r is None:
-        return render_template('nope.html', fullmap=fullmap)
+        return (None, None)
 
     try:
         jdata = json.loads(r.content)
     except ValueError, e:
         debug('login_ptc: could not decode JSON from {}'.format(r.content))
-        return None
+        return (None, None)
 
     # Maximum password length is 15 (sign in page enforces this limit, API does not)
 
@@ -351,7 +713,7 @@ def login_ptc(username, password):
         'username': username,
         'password': password,
     }
-    r1 = SESSION.post(LOGIN_URL, data=data, headers=head)
+    r1 = session.post(LOGIN_URL, data=data, headers=head)
 
     ticket = None
     try:
@@ -359,7 +721,7 @@ def login_ptc(username, password):
     except Exception, e:
         if DEBUG:
             print r1.json()['errors'][0]
-        return None
+        return (None, None)
 
     data1 = {
         'client_id': 'mobile-app_pokemon-go',
@@ -368,17 +730,27 @@ def login_ptc(username, password):
         'grant_type': 'refresh_token',
         'code': ticket,
     }
-    r2 = SESSION.post(LOGIN_OAUTH, data=data1)
+    r2 = session.post(LOGIN_OAUTH, data=data1)
     access_token = re.sub('&expires.*', '', r2.content)
     access_token = re.sub('.*access_token=', '', access_token)
+    expires = re.search('expires=(\d+)', r2.content)
+    lifetime = int(expires.group(1)) if expires else PTC_TOKEN_LIFETIME
 
-    return access_token
+    return (access_token, time.time() + lifetime)
 
 
 def get_heartbeat(service,
                   api_endpoint,
                   access_token,
-                  response, ):
+                  response,
+                  lat=None,
+                  lng=None,
+                  cells=None,
+                  **kwargs):
+    if lat is None or lng is None:
+        (lat, lng) = (FLOAT_LAT, FLOAT_LONG)
+    if cells is None:
+        cells = encode_neighbors(lat, lng)
     m4 = pokemon_pb2.RequestEnvelop.Requests()
     m = pokemon_pb2.RequestEnvelop.MessageSingleInt()
     m.f1 = int(time.time() * 1000)
@@ -387,15 +759,14 @@ def get_heartbeat(service,
     m = pokemon_pb2.RequestEnvelop.MessageSingleString()
     m.bytes = '05daf51635c82611d1aac95c0b051d3ec088a930'
     m5.message = m.SerializeToString()
-    walk = sorted(getNeighbors())
     m1 = pokemon_pb2.RequestEnvelop.Requests()
     m1.type = 106
     m = pokemon_pb2.RequestEnvelop.MessageQuad()
-    m.f1 = ''.join(map(encode, walk))
+    m.f1 = cells
     m.f2 = \
         "\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000"
-    m.lat = COORDS_LATITUDE
-    m.long = COORDS_LONGITUDE
+    m.lat = f2i(lat)
+    m.long = f2i(lng)
     m1.message = m.SerializeToString()
     response = get_profile(service,
                            access_token,
@@ -405,7 +776,9 @@ def get_heartbeat(service,
                            pokemon_pb2.RequestEnvelop.Requests(),
                            m4,
                            pokemon_pb2.RequestEnvelop.Requests(),
-                           m5, )
+                           m5,
+                           coords=(f2i(lat), f2i(lng), f2i(0)),
+                           **kwargs)
 
     try:
         payload = response.payload[0]
@@ -416,30 +789,314 @@ def get_heartbeat(service,
     heartbeat.ParseFromString(payload)
     return heartbeat
 
-def get_token(service, username, password):
+
+class AuthCache(object):
     """
-    Get token if it's not None
-    :return:
-    :rtype:
+    Access tokens, API endpoints and auth tickets of every account, kept in
+    a JSON file so that a restart can skip the logins that are still valid.
+    The file holds credentials, so it is only readable by its owner.
     """
 
-    global global_token
-    if global_token is None:
-        if service == 'ptc':
-            global_token = login_ptc(username, password)
-        else:
-            global_token = login_google(username, password)
-        return global_token
-    else:
-        return global_token
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, entry):
+        with self.lock:
+            # other processes may have saved their accounts since
+            try:
+                with open(self.path) as f:
+                    self.entries.update(json.load(f))
+            except (IOError, ValueError):
+                pass
+            self.entries[key] = entry
+            # one temporary file per process, as shard processes save too
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f)
+            replace_file(tmp_path, self.path)
+
+
+class ScanWorker(object):
+    """
+    A scanning account. Each worker owns its credentials, HTTP session, access
+    token, API endpoint and auth ticket (profile_response.unknown7), as well as
+    its own request budget, so adding accounts adds scan throughput.
+
+    Once logged in, a background thread renews the access token and the auth
+    ticket ahead of their expiry. The three are swapped in together as
+    self.auth, so heartbeats keep using the old ones until the new are ready.
+    Given an AuthCache, they are saved after every renewal and reused on
+    startup for as long as they are valid.
+    """
 
+    def __init__(self, service, username, password, heartbeat_workers=5,
+                 requests_per_second=2.0, request_burst=5,
+                 rpc_timeout=RPC_TIMEOUT, auth_cache=None):
+        self.service = service
+        self.username = username
+        self.password = password
+        self.auth = None  # (access token, API endpoint, profile response)
+        self.token_expiry = 0
+        self.ticket_expiry = 0
+        self.refresh_lock = threading.Lock()
+        self.refresher = None
+        self.auth_cache = auth_cache
+        # one kept-alive connection per heartbeat thread, so concurrent
+        # heartbeats reuse the same few sockets from step to step
+        self.session = create_session(heartbeat_workers)
+        self.rpc_timeout = rpc_timeout
+        self.rate_limiter = TokenBucket(requests_per_second, request_burst)
+        self.pool = ThreadPool(heartbeat_workers)
+
+    def rpc_kwargs(self):
+        return {'session': self.session, 'limiter': self.rate_limiter,
+                'timeout': self.rpc_timeout}
+
+    def login(self):
+        """
+        Log in and fetch the API endpoint and auth ticket, unless already done,
+        and start keeping them fresh
+        :return: None
+        """
+
+        # the credentials may have been set by an earlier login that failed
+        # after that, which still has to start the refresher
+        if self.refresher is not None:
+            return
+        if self.auth is None:
+            self.refresh()
+        (access_token, api_endpoint, profile_response) = self.auth
+
+        print '[+] Login successful'
+
+        payload = profile_response.payload[0]
+        profile = pokemon_pb2.ResponseEnvelop.ProfilePayload()
+        profile.ParseFromString(payload)
+        print '[+] Username: {}'.format(profile.profile.username)
+
+        creation_time = \
+            datetime.fromtimestamp(int(profile.profile.creation_time)
+                                   / 1000)
+        print '[+] You started playing Pokemon Go on: {}'.format(
+            creation_time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        for curr in profile.profile.currency:
+            print '[+] {}: {}'.format(curr.type, curr.amount)
+
+        self.refresher = threading.Thread(target=self.keep_fresh)
+        self.refresher.daemon = True
+        self.refresher.name = 'token_refresher_{}'.format(self.username)
+        self.refresher.start()
+
+    def refresh(self):
+        """
+        Log in again if the access token expires within TOKEN_REFRESH_MARGIN,
+        then fetch a new auth ticket
+        :return: None
+        """
+
+        with self.refresh_lock:
+            auth = self.auth
+            if auth is None:
+                # self.auth is only ever set to complete credentials
+                auth = self.load_auth()
+                if auth is not None and auth[2] is not None:
+                    self.auth = auth
+                    return
+
+            (access_token, api_endpoint, _) = auth or (None, None, None)
+            token_expiry = self.token_expiry
+
+            if (access_token is None or
+                    token_expiry - time.time() < TOKEN_REFRESH_MARGIN):
+                if self.service == 'ptc':
+                    (access_token, token_expiry) = login_ptc(
+                        self.username, self.password, self.session)
+                else:
+                    (access_token, token_expiry) = login_google(
+                        self.username, self.password)
+                if access_token is None:
+                    raise Exception('[-] Wrong username/password for '
+                                    '{}'.format(self.username))
+                print '[+] RPC Session Token: {} ...'.format(access_token[:25])
+                api_endpoint = None
+
+            if api_endpoint is None:
+                api_endpoint = get_api_endpoint(self.service, access_token,
+                                                **self.rpc_kwargs())
+                if api_endpoint is None:
+                    raise Exception('[-] RPC server offline')
+                print '[+] Received API endpoint: {}'.format(api_endpoint)
+
+            profile_response = retrying_get_profile(
+                self.service, access_token, api_endpoint, None,
+                **self.rpc_kwargs())
+            if profile_response is None or not profile_response.payload:
+                raise Exception('Could not get profile')
+
+            self.token_expiry = token_expiry
+            # unknown72 is the ticket's expiry, in milliseconds
+            self.ticket_expiry = (profile_response.unknown7.unknown72 / 1000.0 or
+                                  time.time() + AUTH_TICKET_LIFETIME)
+            self.auth = (access_token, api_endpoint, profile_response)
+            self.save_auth()
+
+    def get_cache_key(self):
+        return '{}:{}'.format(self.service, self.username)
+
+    def load_auth(self):
+        """
+        Take the credentials saved in the AuthCache that are still valid. The
+        auth ticket is only of use along with its token and endpoint.
+        :return: (access token, API endpoint, profile response) tuple, the
+                 profile response None if the ticket needs renewing; None if
+                 the token does
+        """
+
+        if self.auth_cache is None:
+            return None
+        entry = self.auth_cache.get(self.get_cache_key())
+        now = time.time()
+        if (not entry or
+                entry['token_expiry'] - now < TOKEN_REFRESH_MARGIN):
+            return None
+
+        print '[+] Reusing saved session token for {}'.format(self.username)
+        profile_response = None
+        if entry['ticket_expiry'] - now >= TOKEN_REFRESH_MARGIN:
+            profile_response = pokemon_pb2.ResponseEnvelop()
+            profile_response.ParseFromString(
+                base64.b64decode(entry['profile_response']))
+            self.ticket_expiry = entry['ticket_expiry']
+        self.token_expiry = entry['token_expiry']
+        return (entry['access_token'], entry['api_endpoint'], profile_response)
+
+    def save_auth(self):
+        if self.auth_cache is None:
+            return
+        (access_token, api_endpoint, profile_response) = self.auth
+        try:
+            self.auth_cache.put(self.get_cache_key(), {
+                'access_token': access_token,
+                'token_expiry': self.token_expiry,
+                'api_endpoint': api_endpoint,
+                'profile_response': base64.b64encode(
+                    profile_response.SerializeToString()),
+                'ticket_expiry': self.ticket_expiry
+            })
+        except (IOError, OSError), e:
+            # the credentials are good all the same, only a restart needs them
+            print '[-] Could not save credentials for {}: {}'.format(
+                self.username, e)
+
+    def keep_fresh(self):
+        """
+        Renew the credentials ahead of their expiry, for as long as the worker
+        lives. A failed renewal is retried after TOKEN_RETRY_DELAY; meanwhile
+        scans carry on with the credentials they have.
+        """
+
+        while True:
+            expiry = min(self.token_expiry, self.ticket_expiry)
+            # credentials given shorter lives than the margin are still only
+            # renewed every TOKEN_RETRY_DELAY
+            time.sleep(max(TOKEN_RETRY_DELAY,
+                           expiry - TOKEN_REFRESH_MARGIN - time.time()))
+            try:
+                self.refresh()
+                debug('{}: credentials renewed'.format(self.username))
+            except Exception, e:
+                print '[-] Could not renew credentials for {}: {}'.format(
+                    self.username, e)
+                time.sleep(TOKEN_RETRY_DELAY)
+
+    def get_heartbeats(self, locations, cells=None):
+        """
+        Send one heartbeat per location, as many at a time as the pool allows
+        :param locations: list of (lat, lng) tuples to send heartbeats from
+        :param cells: pre-encoded neighbour cells, computed per location if None
+        :return: list of heartbeats, in the same order as locations
+        """
+
+        (access_token, api_endpoint, profile_response) = self.auth
+
+        def heartbeat_at(location):
+            (lat, lng) = location
+            return get_heartbeat(self.service, api_endpoint, access_token,
+                                 profile_response, lat, lng, cells,
+                                 **self.rpc_kwargs())
+
+        return self.pool.map(heartbeat_at, locations)
+
+
+def get_passwords(args):
+    """
+    Prompt for the passwords of the --username not given a --password
+    :return: list of passwords, one per username
+    """
+
+    passwords = list(args.password or [])
+    for username in args.username[len(passwords):]:
+        passwords.append(getpass.getpass('Password for {}: '.format(username)))
+    return passwords
 
-def get_args():
+
+def get_scan_workers(args, shard=None):
+    """
+    Create one ScanWorker per --username, or per username of a shard when
+    the scan is split between processes. Workers are kept between scan
+    cycles so that logins are only done once.
+    :param shard: (shard, shards) tuple, None for every username
+    :return: list of ScanWorker
+    """
+
+    global scan_workers
+    if scan_workers:
+        return scan_workers
+
+    auth_cache = AuthCache(args.auth_cache) if args.auth_cache else None
+    accounts = zip(args.username, get_passwords(args))
+    if shard is not None:
+        (shard, shards) = shard
+        accounts = accounts[shard::shards]
+    for (username, password) in accounts:
+        scan_workers.append(ScanWorker(
+            args.auth_service, username, password,
+            heartbeat_workers=max(1, args.heartbeat_workers),
+            requests_per_second=args.requests_per_second,
+            request_burst=max(1, args.request_burst),
+            rpc_timeout=args.rpc_timeout,
+            auth_cache=auth_cache))
+    return scan_workers
+
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-a', '--auth_service', type=str.lower, help='Auth Service', default='ptc')
-    parser.add_argument('-u', '--username', help='Username', required=True)
-    parser.add_argument('-p', '--password', help='Password', required=False)
+    parser.add_argument(
+        '-u',
+        '--username',
+        help='Username, repeat to scan with several accounts',
+        action='append',
+        required=True)
+    parser.add_argument(
+        '-p',
+        '--password',
+        help='Password, repeat once per --username',
+        action='append',
+        required=False)
     parser.add_argument(
         '-l', '--location', type=parse_unicode, help='Location', required=True)
     parser.add_argument('-st', '--step-limit', help='Steps', required=True)
@@ -451,8 +1108,8 @@ def get_args():
     parser.add_argument(
         "-ar",
         "--auto_refresh",
-        help="Enables an autorefresh that behaves the same as a page reload. " +
-             "Needs an integer value for the amount of seconds")
+        help="Keeps the map up to date, pushing changes to browsers that " +
+             "support it and polling every given number of seconds otherwise")
     parser.add_argument(
         '-dp',
         '--display-pokestop',
@@ -497,67 +1154,305 @@ def get_args():
     	help="Toggles the AM/PM clock for Pokemon timers",
     	action='store_true',
     	default=False)
+    parser.add_argument(
+        '-hw',
+        '--heartbeat-workers',
+        type=int,
+        help='Number of heartbeats sent concurrently per scan step',
+        default=5)
+    parser.add_argument(
+        '-rps',
+        '--requests-per-second',
+        type=parse_positive_float,
+        help='Sustained API request rate allowed per account',
+        default=2.0)
+    parser.add_argument(
+        '-rb',
+        '--request-burst',
+        type=int,
+        help='Number of API requests that may be sent back to back',
+        default=5)
+    parser.add_argument(
+        '-rt',
+        '--rpc-timeout',
+        type=float,
+        help='Seconds to wait for the API server before retrying a request',
+        default=RPC_TIMEOUT)
+    parser.add_argument(
+        '-ac',
+        '--auth-cache',
+        help='File to save session tokens to, so restarts can skip logging in',
+        default=None)
+    parser.add_argument(
+        '-pr',
+        '--processes',
+        type=int,
+        help='Number of processes to split the scan area between, 0 to scan from the web server process; not on Windows',
+        default=0)
+    parser.add_argument(
+        '-sp',
+        '--snapshot-path',
+        help='File to publish snapshots of the sightings to, for web servers in other processes; keep it in a directory only you can write to',
+        default=None)
+    parser.add_argument(
+        '-so',
+        '--scan-only',
+        help='Only scan, publishing to --snapshot-path for web servers run apart, see wsgi.py',
+        action='store_true')
+    parser.add_argument(
+        '-ms',
+        '--max-streams',
+        type=int,
+        help='Number of maps a web server process pushes changes to, the others poll; keep it below the threads of a threaded server',
+        default=MAX_STREAM_CLIENTS)
+    parser.add_argument(
+        '-db',
+        '--db-path',
+        help='SQLite database to persist sightings to, kept in memory only if not set',
+        default=None)
     parser.add_argument(
         '-d', '--debug', help='Debug Mode', action='store_true')
     parser.set_defaults(DEBUG=True)
-    return parser.parse_args()
-
-@memoize
-def login(args):
-    global global_password
-    if not global_password:
-      if args.password:
-        global_password = args.password
-      else:
-        global_password = getpass.getpass()
-
-    access_token = get_token(args.auth_service, args.username, global_password)
-    if access_token is None:
-        raise Exception('[-] Wrong username/password')
-
-    print '[+] RPC Session Token: {} ...'.format(access_token[:25])
-
-    api_endpoint = get_api_endpoint(args.auth_service, access_token)
-    if api_endpoint is None:
-        raise Exception('[-] RPC server offline')
+    args = parser.parse_args(argv)
+    # shard processes inherit the scanner's state by being forked
+    if args.processes and not hasattr(os, 'fork'):
+        parser.error('--processes is not supported on this platform')
+    return args
 
-    print '[+] Received API endpoint: {}'.format(api_endpoint)
-
-    profile_response = retrying_get_profile(args.auth_service, access_token,
-                                            api_endpoint, None)
-    if profile_response is None or not profile_response.payload:
-        raise Exception('Could not get profile')
+class ScanService(object):
+    """
+    The background scanner. Settings, locale, location and accounts are set
+    up once; then every account keeps taking the next due step off the scan
+    schedule, without waiting between cycles, until the service is stopped.
+    A paused service lets the steps in progress finish and sends nothing
+    until it is resumed.
+
+    With --processes, the scan area is split into shards of S2 cells, each
+    scanned by a process of its own with its share of the accounts, so that
+    scans use more than one core and leave the web server's to it. What they
+    find is merged into the store through a queue.
+    """
 
-    print '[+] Login successful'
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        # shared with shard processes, so they stop and pause along
+        self.stopping = multiprocessing.Event()
+        self.unpaused = multiprocessing.Event()
+        self.unpaused.set()
+        self.shard = None
+        self.sink = store.add
+        self.threads = []
+        self.processes = []
+        self.plan = None
+        self.queue = None
+        self.queued = 0
+        self.done = 0
+
+    def setup(self):
+        args = self.args
+        configure(args)
+        self.pokemonsJSON = pokemon_names
+
+        if args.db_path and store.backend is None:
+            print('[+] Storing sightings in ' + args.db_path)
+            store.set_backend(SqliteBackend(args.db_path))
+
+        if args.snapshot_path:
+            print('[+] Publishing snapshots to ' + args.snapshot_path)
+            store.set_snapshot_path(args.snapshot_path)
+
+        # shard processes cannot prompt, so it is done before they start
+        args.password = get_passwords(args)
+
+        self.ignore = []
+        self.only = []
+        if args.ignore:
+            self.ignore = [i.lower().strip() for i in args.ignore.split(',')]
+        elif args.only:
+            self.only = [i.lower().strip() for i in args.only.split(',')]
+
+    def start(self):
+        """
+        Set up and start scanning, in the background
+        :return: None
+        """
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.name = 'search_thread'
+        thread.start()
+
+    def run(self):
+        self.setup()
+        if self.args.processes:
+            self.run_shards()
+        else:
+            self.start_workers()
+
+    def run_shards(self):
+        """
+        Start the shard processes and merge what they find into the store,
+        until the service is stopped
+        """
+
+        # every shard needs an account and a cell of the area of its own
+        cells = get_shard_cells(get_spiral(origin_lat, origin_lon,
+                                           int(self.args.step_limit)))
+        shards = min(self.args.processes, len(self.args.username), len(cells))
+        results = multiprocessing.Queue()
+        for shard in xrange(shards):
+            process = multiprocessing.Process(target=self.run_shard,
+                                              args=((shard, shards), results))
+            process.daemon = True
+            process.name = 'scan_shard_{}'.format(shard)
+            process.start()
+            self.processes.append(process)
+
+        while not self.stopping.is_set():
+            try:
+                (pokemons, gyms, pokestops) = results.get(timeout=1)
+            except Queue.Empty:
+                # batches expire what has disappeared, without them it is
+                # done here
+                clear_stale_pokemons()
+                continue
+            store.add(pokemons, gyms, pokestops)
+
+    def run_shard(self, shard, results):
+        """
+        Entry point of a shard process
+        :param shard: (shard, shards) tuple
+        :param results: queue to put the (pokemons, gyms, pokestops) found on
+        """
+
+        self.shard = shard
+        self.sink = lambda *found: results.put(found)
+        self.start_workers()
+        for thread in self.threads:
+            thread.join()
+
+    def start_workers(self):
+        self.workers = get_scan_workers(self.args, self.shard)
+        self.plan = get_scan_plan(origin_lat, origin_lon,
+                                  int(self.args.step_limit), self.shard)
+        # every account takes the highest scoring step left when it is free,
+        # so the stalest and most viewed steps are scanned first
+        for (i, worker) in enumerate(self.workers):
+            thread = threading.Thread(target=self.work, args=(worker,))
+            thread.daemon = True
+            thread.name = 'scan_worker_{}'.format(i)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        self.unpaused.set()
+
+    def pause(self):
+        self.unpaused.clear()
+
+    def resume(self):
+        self.unpaused.set()
+
+    def is_paused(self):
+        return not self.unpaused.is_set()
+
+    def work(self, worker):
+        while True:
+            self.unpaused.wait()
+            if self.stopping.is_set():
+                return
+            try:
+                worker.login()
+            except Exception, e:
+                print '[-] Login failed for {}: {}'.format(worker.username, e)
+                self.stopping.wait(TOKEN_RETRY_DELAY)
+                continue
 
-    payload = profile_response.payload[0]
-    profile = pokemon_pb2.ResponseEnvelop.ProfilePayload()
-    profile.ParseFromString(payload)
-    print '[+] Username: {}'.format(profile.profile.username)
+            index = self.next_step()
+            if index is None:
+                self.stopping.wait(SCAN_IDLE_DELAY)
+                continue
 
-    creation_time = \
-        datetime.fromtimestamp(int(profile.profile.creation_time)
-                               / 1000)
-    print '[+] You started playing Pokemon Go on: {}'.format(
-        creation_time.strftime('%Y-%m-%d %H:%M:%S'))
+            try:
+                self.sink(*process_step(self.args, worker,
+                                        self.plan.steps[index],
+                                        self.pokemonsJSON, self.ignore,
+                                        self.only, self.plan.schedule))
+            except Exception, e:
+                # the step stays due, the next cycle scans it again
+                print '[-] Scan of step {} failed: {}'.format(index, e)
+            with self.lock:
+                self.done += 1
+                debug('looping: step {} of {}'.format(self.done, self.queued))
+                print('Completed: ' + str(
+                    self.done * 100.0 / self.queued) + '%')
+
+    def next_step(self):
+        """
+        Index of the step to scan next. Once every step due has been
+        scanned, the steps due by now are queued.
+        :return: step index, None if no step is due
+        """
+
+        with self.lock:
+            index = self.queue.pop() if self.queue is not None else None
+            if index is not None:
+                return index
+            if self.done < self.queued:
+                # the last steps of the cycle are still being scanned
+                return None
+            if self.queued:
+                self.finish_cycle()
+
+            # shard processes leave the store to the parent: theirs is a
+            # copy, forked along with whatever locks its threads held
+            if self.shard is None:
+                clear_stale_pokemons()
+            # only steps whose spawn points have spawned since they were last
+            # scanned are scanned again, besides the regular rescans finding
+            # new spawn points and those of steps people are looking at
+            self.queue = self.plan.schedule.get_queue()
+            self.queued = len(self.queue)
+            self.done = 0
+            if self.queued:
+                print('[+] {} of {} steps due, {} spawn points known'.format(
+                    self.queued, len(self.plan.steps),
+                    self.plan.schedule.get_spawn_point_count()))
+            return self.queue.pop()
+
+    def finish_cycle(self):
+        print('[+] API calls: {attempts} attempts, {retries} retried, '
+              '{gave_up} given up, {circuits_opened} circuits opened, '
+              '{circuit_waits} waits on open circuits'.format(
+                  **RETRY_POLICY.get_counters()))
+
+        global NEXT_LAT, NEXT_LONG
+        if (NEXT_LAT and NEXT_LONG and
+                (NEXT_LAT != FLOAT_LAT or NEXT_LONG != FLOAT_LONG)):
+            print('Update to next location %f, %f' % (NEXT_LAT, NEXT_LONG))
+            set_location_coords(NEXT_LAT, NEXT_LONG, 0)
+            NEXT_LAT = 0
+            NEXT_LONG = 0
+        else:
+            set_location_coords(origin_lat, origin_lon, 0)
 
-    for curr in profile.profile.currency:
-        print '[+] {}: {}'.format(curr.type, curr.amount)
 
-    return api_endpoint, access_token, profile_response
+def configure(args):
+    """
+    Apply the settings the map is shown with, for the scanner and the web
+    server alike
+    """
 
-def main():
     full_path = os.path.realpath(__file__)
     (path, filename) = os.path.split(full_path)
 
-    args = get_args()
-
-    if args.auth_service not in ['ptc', 'google']:
-        print '[!] Invalid Auth service specified'
-        return
-
+    global locale
+    locale = args.locale
     print('[+] Locale is ' + args.locale)
-    pokemonsJSON = json.load(
+    global pokemon_names
+    pokemon_names = json.load(
         open(path + '/locales/pokemon.' + args.locale + '.json'))
 
     if args.debug:
@@ -565,7 +1460,6 @@ def main():
         DEBUG = True
         print '[!] DEBUG mode on'
 
-    # only get location for first run
     if not (FLOAT_LAT and FLOAT_LONG):
       print('[+] Getting initial location')
       retrying_set_location(args.location)
@@ -578,92 +1472,72 @@ def main():
     	global is_ampm_clock
     	is_ampm_clock = True
 
-    api_endpoint, access_token, profile_response = login(args)
+    global max_stream_clients
+    max_stream_clients = args.max_streams
 
-    clear_stale_pokemons()
 
-    steplimit = int(args.step_limit)
+def main(args):
+    """
+    Start the scan service in the background
+    :return: the ScanService, None if the arguments are invalid
+    """
 
-    ignore = []
-    only = []
-    if args.ignore:
-        ignore = [i.lower().strip() for i in args.ignore.split(',')]
-    elif args.only:
-        only = [i.lower().strip() for i in args.only.split(',')]
+    if args.auth_service not in ['ptc', 'google']:
+        print '[!] Invalid Auth service specified'
+        return None
 
-    pos = 1
-    x = 0
-    y = 0
-    dx = 0
-    dy = -1
-    steplimit2 = steplimit**2
-    for step in range(steplimit2):
-        #starting at 0 index
-        debug('looping: step {} of {}'.format((step+1), steplimit**2))
-        #debug('steplimit: {} x: {} y: {} pos: {} dx: {} dy {}'.format(steplimit2, x, y, pos, dx, dy))
-        # Scan location math
-        if -steplimit2 / 2 < x <= steplimit2 / 2 and -steplimit2 / 2 < y <= steplimit2 / 2:
-            set_location_coords(x * 0.0025 + origin_lat, y * 0.0025 + origin_lon, 0)
-        if x == y or x < 0 and x == -y or x > 0 and x == 1 - y:
-            (dx, dy) = (-dy, dx)
+    global scan_service
+    scan_service = ScanService(args)
+    scan_service.start()
+    return scan_service
 
-        (x, y) = (x + dx, y + dy)
 
-        process_step(args, api_endpoint, access_token, profile_response,
-                     pokemonsJSON, ignore, only)
+def serve(args):
+    """
+    Set up this process to serve the map only, from the snapshots a scanner
+    run with --scan-only publishes to --snapshot-path. This is how web server
+    processes of a WSGI server are set up, see wsgi.py.
+    """
 
-        print('Completed: ' + str(
-            ((step+1) + pos * .25 - .25) / (steplimit2) * 100) + '%')
+    configure(args)
+    if not args.snapshot_path:
+        print '[!] No --snapshot-path to serve sightings from'
+        return
+    print('[+] Serving sightings from ' + args.snapshot_path)
+    store.follow(args.snapshot_path)
 
-    global NEXT_LAT, NEXT_LONG
-    if (NEXT_LAT and NEXT_LONG and
-            (NEXT_LAT != FLOAT_LAT or NEXT_LONG != FLOAT_LONG)):
-        print('Update to next location %f, %f' % (NEXT_LAT, NEXT_LONG))
-        set_location_coords(NEXT_LAT, NEXT_LONG, 0)
-        NEXT_LAT = 0
-        NEXT_LONG = 0
-    else:
-        set_location_coords(origin_lat, origin_lon, 0)
-
-    register_background_thread()
-
-
-def process_step(args, api_endpoint, access_token, profile_response,
-                 pokemonsJSON, ignore, only):
-    print('[+] Searching for Pokemon at location {} {}'.format(FLOAT_LAT, FLOAT_LONG))
-    origin = LatLng.from_degrees(FLOAT_LAT, FLOAT_LONG)
-    step_lat = FLOAT_LAT
-    step_long = FLOAT_LONG
-    parent = CellId.from_lat_lng(LatLng.from_degrees(FLOAT_LAT,
-                                                     FLOAT_LONG)).parent(15)
-    h = get_heartbeat(args.auth_service, api_endpoint, access_token,
-                      profile_response)
-    hs = [h]
-    seen = {}
 
-    for child in parent.children():
-        latlng = LatLng.from_point(Cell(child).get_center())
-        set_location_coords(latlng.lat().degrees, latlng.lng().degrees, 0)
-        hs.append(
-            get_heartbeat(args.auth_service, api_endpoint, access_token,
-                          profile_response))
-    set_location_coords(step_lat, step_long, 0)
+def process_step(args, worker, step, pokemonsJSON, ignore, only,
+                 schedule=None):
+    print('[+] Searching for Pokemon at location {} {}'.format(step.lat,
+                                                               step.lng))
+
+    # the parent cell and its four children are requested together, so a
+    # step costs one round-trip instead of five
+    started = time.time()
+    hs = worker.get_heartbeats(step.locations, step.cells)
+    seen = {}
     visible = []
+    pokemons = {}
+    gyms = {}
+    pokestops = {}
 
+    processed = 0  # heartbeats whose cells were all gone through
     for hh in hs:
+        # the other heartbeats of the step still count if one did not get
+        # through
+        if hh is None:
+            continue
         try:
             for cell in hh.cells:
                 for wild in cell.WildPokemon:
                     hash = wild.SpawnPointId;
                     if hash not in seen.keys() or (seen[hash].TimeTillHiddenMs <= wild.TimeTillHiddenMs):
                         visible.append(wild)    
-                    seen[hash] = wild.TimeTillHiddenMs
+                    seen[hash] = wild
                 if cell.Fort:
                     for Fort in cell.Fort:
                         if Fort.Enabled == True:
-                            if args.china:
-                                (Fort.Latitude, Fort.Longitude) = \
-transform_from_wgs_to_gcj(Location(Fort.Latitude, Fort.Longitude))
                             if Fort.GymPoints and args.display_gym:
                                 gyms[Fort.FortId] = [Fort.Team, Fort.Latitude,
                                                      Fort.Longitude, Fort.GymPoints]
@@ -679,7 +1553,16 @@ transform_from_wgs_to_gcj(Location(Fort.Latitude, Fort.Longitude))
                                     pokestops[Fort.FortId] = [Fort.Latitude,
                                                               Fort.Longitude, expire_time]
         except AttributeError:
-            break
+            continue
+        processed += 1
+
+    if schedule is not None:
+        # a step none of whose heartbeats could be gone through is still due
+        if processed:
+            schedule.mark_scanned(step.index, started)
+        for poke in visible:
+            schedule.record(step.index, poke.SpawnPointId,
+                            poke.TimeTillHiddenMs / 1000.0)
 
     for poke in visible:
         pokeid = str(poke.pokemon.PokemonId)
@@ -694,11 +1577,6 @@ transform_from_wgs_to_gcj(Location(Fort.Latitude, Fort.Longitude))
         disappear_timestamp = time.time() + poke.TimeTillHiddenMs \
             / 1000
 
-        if args.china:
-            (poke.Latitude, poke.Longitude) = \
-                transform_from_wgs_to_gcj(Location(poke.Latitude,
-                    poke.Longitude))
-
         pokemons[poke.SpawnPointId] = {
             "lat": poke.Latitude,
             "lng": poke.Longitude,
@@ -707,48 +1585,33 @@ transform_from_wgs_to_gcj(Location(Fort.Latitude, Fort.Longitude))
             "name": pokename
         }
 
-def clear_stale_pokemons():
-    current_time = time.time()
-
-    for pokemon_key in pokemons.keys():
-        pokemon = pokemons[pokemon_key]
-        if current_time > pokemon['disappear_time']:
-            print "[+] removing stale pokemon %s at %f, %f from list" % (
-                pokemon['name'].encode('utf-8'), pokemon['lat'], pokemon['lng'])
-            del pokemons[pokemon_key]
+    if args.china:
+        transform_sightings(pokemons, gyms, pokestops)
 
+    return (pokemons, gyms, pokestops)
 
-def register_background_thread(initial_registration=False):
+def transform_sightings(pokemons, gyms, pokestops):
     """
-    Start a background thread to search for Pokemon
-    while Flask is still able to serve requests for the map
-    :param initial_registration: True if first registration and thread should start immediately, False if it's being called by the finishing thread to schedule a refresh
-    :return: None
+    Move the sightings of a step from WGS-84 to GCJ-02 coordinates, in place
+    and all in one batch
     """
 
-    debug('register_background_thread called')
-    global search_thread
-
-    if initial_registration:
-        if not werkzeug.serving.is_running_from_reloader():
-            debug(
-                'register_background_thread: not running inside Flask so not starting thread')
-            return
-        if search_thread:
-            debug(
-                'register_background_thread: initial registration requested but thread already running')
-            return
-
-        debug('register_background_thread: initial registration')
-        search_thread = threading.Thread(target=main)
-
-    else:
-        debug('register_background_thread: queueing')
-        search_thread = threading.Timer(30, main)  # delay, in seconds
+    targets = ([(pokemon, 'lat', 'lng') for pokemon in pokemons.itervalues()] +
+               [(gym, 1, 2) for gym in gyms.itervalues()] +
+               [(stop, 0, 1) for stop in pokestops.itervalues()])
+    if not targets:
+        return
+    (lats, lngs) = transform_batch_from_wgs_to_gcj(
+        [item[lat_key] for (item, lat_key, lng_key) in targets],
+        [item[lng_key] for (item, lat_key, lng_key) in targets])
+    for ((item, lat_key, lng_key), lat, lng) in zip(targets, lats, lngs):
+        item[lat_key] = float(lat)
+        item[lng_key] = float(lng)
 
-    search_thread.daemon = True
-    search_thread.name = 'search_thread'
-    search_thread.start()
+def clear_stale_pokemons():
+    for pokemon in store.clear_stale_pokemons():
+        print "[+] removing stale pokemon %s at %f, %f from list" % (
+            pokemon['name'].encode('utf-8'), pokemon['lat'], pokemon['lng'])
 
 
 def create_app():
@@ -761,18 +1624,203 @@ def create_app():
 app = create_app()
 
 
+def conditional(get_state):
+    """
+    Serve a view with a strong ETag derived from everything its body depends
+    on, so a client that already has the body gets a 304 without the view
+    being run. Bodies are gzipped for clients that accept it, and kept by ETag
+    so concurrent clients asking for the same state share one rendering.
+    :param get_state: returns the state, besides the URL, the body depends on
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            request = flask.request
+            gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+            state = (request.path, request.query_string, get_state())
+            etag = hashlib.sha1(repr(state)).hexdigest()
+            if gzipped:
+                etag += '-gzip'
+            headers = {'ETag': '"{}"'.format(etag),
+                       'Cache-Control': 'no-cache',
+                       'Vary': 'Accept-Encoding'}
+            if request.if_none_match.contains(etag):
+                return flask.Response(status=304, headers=headers)
+
+            with response_cache_lock:
+                cached = response_cache.pop(etag, None)
+                if cached is not None:
+                    response_cache[etag] = cached
+            if cached is None:
+                response = flask.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                if gzipped:
+                    compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                                  16 + zlib.MAX_WBITS)
+                    body = compressor.compress(body) + compressor.flush()
+                cached = (body, response.mimetype)
+                with response_cache_lock:
+                    response_cache[etag] = cached
+                    while len(response_cache) > RESPONSE_CACHE_SIZE:
+                        response_cache.popitem(last=False)
+
+            (body, mimetype) = cached
+            response = flask.Response(body, mimetype=mimetype, headers=headers)
+            if gzipped:
+                response.headers['Content-Encoding'] = 'gzip'
+            return response
+        return wrapper
+    return decorator
+
+
+def get_marker_state():
+    """ State besides the sightings that markers are rendered from """
+    return (store.get_state(), origin_lat, origin_lon, locale, is_ampm_clock)
+
+
+@app.before_request
+def note_viewer_interest():
+    """ Viewport queries make the scanner favour the steps they cover """
+    if flask.request.endpoint not in ('data', 'raw_data', 'stream'):
+        return
+    bounds = get_bounds_arg()
+    plan = scan_plan
+    if bounds and plan is not None:
+        plan.schedule.add_interest(plan.get_steps_in(bounds))
+
+
 @app.route('/data')
+@conditional(get_marker_state)
 def data():
-    """ Gets all the PokeMarkers via REST """
-    return json.dumps(get_pokemarkers())
+    """
+    Gets all the PokeMarkers via REST, or only the ones that changed since the
+    cursor given as ?since=. Both can be limited to ?bounds=. Maps zoomed out
+    to CLUSTER_LEVEL or less (?zoom=) get cluster markers instead.
+    ?format=bin returns every marker in the compact format of get_feed.
+    """
+    bounds = get_bounds_arg()
+    if flask.request.args.get('format') == 'bin':
+        return flask.Response(get_feed(bounds),
+                              mimetype='application/octet-stream')
+    since = flask.request.args.get('since')
+    zoom = flask.request.args.get('zoom', type=int)
+    if zoom is not None and zoom <= CLUSTER_LEVEL:
+        return json.dumps(get_cluster_markers(max(zoom, 0), since, bounds))
+    if since is not None:
+        return json.dumps(get_pokemarker_changes(since, bounds))
+    return json.dumps(get_pokemarkers(bounds))
+
+@app.route('/stream')
+def stream():
+    """
+    Pushes PokeMarker changes as server-sent events, in the format of
+    /data?since=, limited to ?bounds= if given. Every client reads the
+    store's change log at its own pace, so a slow client only falls behind
+    (and eventually gets a reset) instead of making the server queue events
+    for it.
+    """
+    global stream_clients
+
+    bounds = get_bounds_arg()
+    cursor = (flask.request.headers.get('Last-Event-ID') or
+              flask.request.args.get('since'))
+
+    with stream_clients_lock:
+        if stream_clients >= max_stream_clients:
+            return flask.Response('Too many streams', status=503)
+        stream_clients += 1
+
+    def events(cursor):
+        global stream_clients
+        try:
+            while True:
+                delta = get_pokemarker_changes(cursor, bounds)
+                cursor = delta['cursor']
+                if (delta['reset'] or delta['inserted'] or delta['updated'] or
+                        delta['expired']):
+                    yield 'id: {}\ndata: {}\n\n'.format(cursor,
+                                                         json.dumps(delta))
+                else:
+                    yield ': keepalive\n\n'
+                store.wait(parse_cursor(cursor)[1], STREAM_KEEPALIVE)
+        finally:
+            with stream_clients_lock:
+                stream_clients -= 1
+
+    return flask.Response(events(cursor), mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache'})
+
 
 @app.route('/raw_data')
+@conditional(lambda: store.get_state())
 def raw_data():
     """ Gets raw data for pokemons/gyms/pokestops via REST """
-    return flask.jsonify(pokemons=pokemons, gyms=gyms, pokestops=pokestops)
+    bounds = get_bounds_arg()
+    if bounds:
+        (pokemons, gyms, pokestops) = store.get_in_bounds(bounds)
+        return flask.jsonify(pokemons=pokemons, gyms=gyms, pokestops=pokestops)
+    snapshot = store.get_snapshot()
+    return flask.jsonify(pokemons=snapshot.get_pokemons(),
+                         gyms=snapshot.gyms,
+                         pokestops=snapshot.pokestops)
+
+
+def get_bounds_arg():
+    """
+    Parse ?bounds=south,west,north,east, the format of Google Maps'
+    LatLngBounds.toUrlValue()
+    :return: (south, west, north, east) tuple, None if not given
+    """
+    bounds = flask.request.args.get('bounds')
+    if not bounds:
+        return None
+    try:
+        (south, west, north, east) = [float(x) for x in bounds.split(',')]
+    except ValueError:
+        flask.abort(400)
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and
+            -180 <= east <= 180):
+        flask.abort(400)
+    return (south, west, north, east)
+
+
+@app.route('/history')
+def history():
+    """ Gets past and present pokemon sightings via REST """
+    request_args = flask.request.args
+    return json.dumps(store.query_pokemons(
+        pokemon_id=request_args.get('id', type=int),
+        since=request_args.get('since', type=float),
+        until=request_args.get('until', type=float),
+        cell_id=get_cell_arg(),
+        limit=max(1, min(request_args.get('limit', 1000, type=int), 10000))))
+
+
+def get_cell_arg():
+    """
+    Parse ?cell=, an S2 cell token
+    :return: cell ID, None if not given
+    """
+
+    cell = flask.request.args.get('cell')
+    if not cell:
+        return None
+    if len(cell) > 16:
+        flask.abort(400)
+    try:
+        cell_id = CellId.from_token(cell)
+    except ValueError:
+        flask.abort(400)
+    if not cell_id.is_valid():
+        flask.abort(400)
+    return cell_id.id()
 
 
 @app.route('/config')
+@conditional(lambda: (FLOAT_LAT, FLOAT_LONG))
 def config():
     """ Gets the settings for the Google Maps via REST"""
     center = {
@@ -789,7 +1837,9 @@ def fullmap():
     clear_stale_pokemons()
 
     return render_template(
-        'example_fullmap.html', key=GOOGLEMAPS_KEY, fullmap=get_map(), auto_refresh=auto_refresh)
+        'example_fullmap.html', key=GOOGLEMAPS_KEY, fullmap=get_map(), auto_refresh=auto_refresh,
+        pokemon_names=pokemon_names, is_ampm_clock=is_ampm_clock,
+        cluster_zoom=CLUSTER_LEVEL)
 
 
 @app.route('/next_loc')
@@ -804,11 +1854,15 @@ def next_loc():
         print('[+] Saved next location as %s,%s' % (lat, lon))
         NEXT_LAT = float(lat)
         NEXT_LONG = float(lon)
+        plan = scan_plan
+        if plan is not None:
+            plan.schedule.add_interest(
+                [plan.get_nearest_step(NEXT_LAT, NEXT_LONG)])
         return 'ok'
 
 
-def get_pokemarkers():
-    pokeMarkers = [{
+def get_start_marker():
+    return {
         'icon': icons.dots.red,
         'lat': origin_lat,
         'lng': origin_lon,
@@ -816,94 +1870,335 @@ def get_pokemarkers():
         'type': 'custom',
         'key': 'start-position',
         'disappear_time': -1
-    }]
+    }
 
-    for pokemon_key in pokemons:
-        pokemon = pokemons[pokemon_key]
-        datestr = datetime.fromtimestamp(pokemon[
-            'disappear_time'])
-        dateoutput = datestr.strftime("%H:%M:%S")
-        if is_ampm_clock:
-        	dateoutput = datestr.strftime("%I:%M%p").lstrip('0')
-        pokemon['disappear_time_formatted'] = dateoutput
-
-        LABEL_TMPL = u'''
+
+LABEL_TMPL = u'''
 <div><b>{name}</b><span> - </span><small><a href='http://www.pokemon.com/us/pokedex/{id}' target='_blank' title='View in Pokedex'>#{id}</a></small></div>
 <div>Disappears at - {disappear_time_formatted} <span class='label-countdown' disappears-at='{disappear_time}'></span></div>
 <div><a href='https://www.google.com/maps/dir/Current+Location/{lat},{lng}' target='_blank' title='View in Maps'>Get Directions</a></div>
 '''
-        label = LABEL_TMPL.format(**pokemon)
-        #  NOTE: `infobox` field doesn't render multiple line string in frontend
-        label = label.replace('\n', '')
-
-        pokeMarkers.append({
-            'type': 'pokemon',
-            'key': pokemon_key,
-            'disappear_time': pokemon['disappear_time'],
-            'icon': 'static/icons/%d.png' % pokemon["id"],
-            'lat': pokemon["lat"],
-            'lng': pokemon["lng"],
-            'infobox': label
-        })
+#  NOTE: `infobox` field doesn't render multiple line string in frontend
+LABEL_TMPL = LABEL_TMPL.replace('\n', '')
 
-    for gym_key in gyms:
-        gym = gyms[gym_key]
-        if gym[0] == 0:
-            color = "rgba(0,0,0,.4)"
-        if gym[0] == 1:
-            color = "rgba(74, 138, 202, .6)"
-        if gym[0] == 2:
-            color = "rgba(240, 68, 58, .6)"
-        if gym[0] == 3:
-            color = "rgba(254, 217, 40, .6)"
-
-        icon = 'static/forts/'+numbertoteam[gym[0]]+'_large.png'
-        pokeMarkers.append({
-            'icon': 'static/forts/' + numbertoteam[gym[0]] + '.png',
-            'type': 'gym',
-            'key': gym_key,
+GYM_LABEL_TMPL = "<div><center><small>Gym owned by:</small><br><b style='color:{color}'>Team {team}</b><br><img id='{team}' height='100px' src='{icon}'><br>Prestige: {points}</center>"
+
+GYM_COLORS = {
+    0: "rgba(0,0,0,.4)",
+    1: "rgba(74, 138, 202, .6)",
+    2: "rgba(240, 68, 58, .6)",
+    3: "rgba(254, 217, 40, .6)",
+}
+
+
+def get_pokemon_marker(pokemon_key, pokemon):
+    datestr = datetime.fromtimestamp(pokemon[
+        'disappear_time'])
+    dateoutput = datestr.strftime("%H:%M:%S")
+    if is_ampm_clock:
+    	dateoutput = datestr.strftime("%I:%M%p").lstrip('0')
+
+    label = LABEL_TMPL.format(disappear_time_formatted=dateoutput, **pokemon)
+
+    return {
+        'type': 'pokemon',
+        'key': pokemon_key,
+        'disappear_time': pokemon['disappear_time'],
+        'icon': 'static/icons/%d.png' % pokemon["id"],
+        'lat': pokemon["lat"],
+        'lng': pokemon["lng"],
+        'infobox': label
+    }
+
+
+def get_gym_marker(gym_key, gym):
+    team = numbertoteam[gym[0]]
+    return {
+        'icon': 'static/forts/' + team + '.png',
+        'type': 'gym',
+        'key': gym_key,
+        'disappear_time': -1,
+        'lat': gym[1],
+        'lng': gym[2],
+        'infobox': GYM_LABEL_TMPL.format(
+            color=GYM_COLORS[gym[0]],
+            team=team,
+            icon='static/forts/' + team + '_large.png',
+            points=gym[3])
+    }
+
+
+def get_pokestop_marker(stop_key, stop):
+    if stop[2] > 0:
+        return {
+            'type': 'lured_stop',
+            'key': stop_key,
             'disappear_time': -1,
-            'lat': gym[1],
-            'lng': gym[2],
-            'infobox': "<div><center><small>Gym owned by:</small><br><b style='color:" + color + "'>Team " + numbertoteam[gym[0]] + "</b><br><img id='" + numbertoteam[gym[0]] + "' height='100px' src='"+icon+"'><br>Prestige: " + str(gym[3]) + "</center>"
-        })
-    for stop_key in pokestops:
-        stop = pokestops[stop_key]
-        if stop[2] > 0:
-            pokeMarkers.append({
-                'type': 'lured_stop',
-                'key': stop_key,
-                'disappear_time': -1,
-                'icon': 'static/forts/PstopLured.png',
-                'lat': stop[0],
-                'lng': stop[1],
-                'infobox': 'Lured Pokestop, expires at ' + stop[2],
-            })
+            'icon': 'static/forts/PstopLured.png',
+            'lat': stop[0],
+            'lng': stop[1],
+            'infobox': 'Lured Pokestop, expires at ' + stop[2],
+        }
+    else:
+        return {
+            'type': 'stop',
+            'key': stop_key,
+            'disappear_time': -1,
+            'icon': 'static/forts/Pstop.png',
+            'lat': stop[0],
+            'lng': stop[1],
+            'infobox': 'Pokestop',
+        }
+
+
+def get_cluster_marker(cluster):
+    pokemons = sorted(cluster['pokemons'].items(),
+                      key=lambda (pokemon_id, count): -count)
+    infobox = "<div><b>" + str(cluster['count']) + " sightings</b></div><div>"
+    for (pokemon_id, count) in pokemons:
+        infobox += "<img height='32px' src='static/icons/%d.png' title='#%d'>x%d " % (
+            pokemon_id, pokemon_id, count)
+    infobox += "</div>"
+    if cluster['gyms']:
+        infobox += "<div>Gyms: " + str(cluster['gyms']) + "</div>"
+    if cluster['pokestops']:
+        infobox += "<div>Pokestops: " + str(cluster['pokestops']) + "</div>"
+
+    return {
+        'type': 'cluster',
+        'key': CellId(cluster['cell_id']).to_token(),
+        'disappear_time': -1,
+        'icon': icons.dots.blue,
+        'lat': cluster['lat'],
+        'lng': cluster['lng'],
+        'count': cluster['count'],
+        'pokemons': cluster['pokemons'],
+        'gyms': cluster['gyms'],
+        'pokestops': cluster['pokestops'],
+        'infobox': infobox,
+    }
+
+
+def get_cluster_markers(zoom, cursor=None, bounds=None):
+    """
+    One marker per S2 cell of the level matching a map zoom, roughly a
+    quarter of a map tile wide, with the number of sightings in it
+    :param zoom: Google Maps zoom level, at most CLUSTER_LEVEL
+    :param cursor: if given, answer in /data?since= format; clusters are
+                   sent as a reset whenever anything changed after cursor
+    :param bounds: (south, west, north, east) to limit clusters to, if any
+    """
+
+    state = store.get_state()
+    if cursor is not None and parse_cursor(cursor) == state:
+        return {
+            'cursor': format_cursor(state),
+            'reset': False,
+            'inserted': [],
+            'updated': [],
+            'expired': [],
+        }
+
+    markers = [get_start_marker()]
+    for cluster in store.get_clusters(zoom, bounds):
+        markers.append(get_cluster_marker(cluster))
+    if cursor is None:
+        return markers
+    return {
+        'cursor': format_cursor(state),
+        'reset': True,
+        'inserted': markers,
+        'updated': [],
+        'expired': [],
+    }
+
+
+# Binary marker feed: a header with the store epoch and version and the number
+# of records, then one record per marker. Coordinates are degrees * 1e6. value is
+# the disappear timestamp of pokemons, the prestige of gyms and the lure
+# expiration of lured pokestops, in seconds since midnight. Records end with
+# the marker key, which is at most 255 bytes long.
+FEED_HEADER = struct.Struct('<III')
+FEED_RECORD = struct.Struct('<iiBBHIB')  # lat, lng, type, team, id, value, key length
+FEED_TYPES = {'custom': 0, 'pokemon': 1, 'gym': 2, 'stop': 3, 'lured_stop': 4}
+
+
+def pack_feed_record(marker_type, key, lat, lng, team=0, pokemon_id=0,
+                     value=0):
+    key = key.encode('utf-8')[:255]
+    return FEED_RECORD.pack(int(round(lat * 1e6)), int(round(lng * 1e6)),
+                            FEED_TYPES[marker_type], team, pokemon_id,
+                            int(value), len(key)) + key
+
+
+def get_feed_record(kind, key, item):
+    record = store.get_rendered(kind, key, 'feed')
+    if record is None:
+        if kind == 'pokemon':
+            record = pack_feed_record('pokemon', key, item['lat'], item['lng'],
+                                      pokemon_id=item['id'],
+                                      value=item['disappear_time'])
+        elif kind == 'gym':
+            record = pack_feed_record('gym', key, item[1], item[2],
+                                      team=item[0], value=item[3])
+        elif item[2]:
+            (h, m, s) = [int(x) for x in item[2].split(':')]
+            record = pack_feed_record('lured_stop', key, item[0], item[1],
+                                      value=h * 3600 + m * 60 + s)
         else:
-            pokeMarkers.append({
-                'type': 'stop',
-                'key': stop_key,
-                'disappear_time': -1,
-                'icon': 'static/forts/Pstop.png',
-                'lat': stop[0],
-                'lng': stop[1],
-                'infobox': 'Pokestop',
-            })
+            record = pack_feed_record('stop', key, item[0], item[1])
+        store.set_rendered(kind, key, item, 'feed', record)
+    return record
+
+
+def get_feed(bounds=None):
+    """
+    Every marker packed as FEED_RECORDs, for the map to build itself
+    :param bounds: (south, west, north, east) to limit markers to, if any
+    :return: binary string
+    """
+
+    snapshot = store.get_snapshot()
+    if bounds:
+        (pokemons, gyms, pokestops) = store.get_in_bounds(bounds)
+    else:
+        pokemons = snapshot.get_pokemons()
+        gyms = snapshot.gyms
+        pokestops = snapshot.pokestops
+
+    records = []
+    if origin_lat is not None:
+        records.append(pack_feed_record('custom', 'start-position',
+                                        origin_lat, origin_lon))
+    for (kind, items) in (('pokemon', pokemons), ('gym', gyms),
+                          ('pokestop', pokestops)):
+        for key in items:
+            records.append(get_feed_record(kind, key, items[key]))
+    return (FEED_HEADER.pack(snapshot.epoch, snapshot.version, len(records)) +
+            ''.join(records))
+
+
+def get_marker(kind, key, item):
+    """
+    Marker of a sighting, rendered once per change of the sighting and cached
+    with it in the store. Markers are shared, callers must not modify them.
+    """
+    variant = (locale, is_ampm_clock)
+    marker = store.get_rendered(kind, key, variant)
+    if marker is None:
+        if kind == 'pokemon':
+            marker = get_pokemon_marker(key, item)
+        elif kind == 'gym':
+            marker = get_gym_marker(key, item)
+        else:
+            marker = get_pokestop_marker(key, item)
+        store.set_rendered(kind, key, item, variant, marker)
+    return marker
+
+
+def get_pokemarkers(bounds=None):
+    pokeMarkers = [get_start_marker()]
+
+    if bounds:
+        (pokemons, gyms, pokestops) = store.get_in_bounds(bounds)
+    else:
+        snapshot = store.get_snapshot()
+        pokemons = snapshot.get_pokemons()
+        gyms = snapshot.gyms
+        pokestops = snapshot.pokestops
+
+    for pokemon_key in pokemons:
+        pokeMarkers.append(get_marker('pokemon', pokemon_key,
+                                      pokemons[pokemon_key]))
+
+    for gym_key in gyms:
+        pokeMarkers.append(get_marker('gym', gym_key, gyms[gym_key]))
+
+    for stop_key in pokestops:
+        pokeMarkers.append(get_marker('pokestop', stop_key,
+                                      pokestops[stop_key]))
     return pokeMarkers
 
 
+def format_cursor(state):
+    """
+    Cursor handed to clients for an (epoch, version) state of the store
+    """
+    return '{}-{}'.format(*state)
+
+
+def parse_cursor(cursor):
+    """
+    :return: (epoch, version) state of a cursor from format_cursor, (None, 0)
+             for a missing or malformed one
+    """
+    try:
+        (epoch, version) = [int(x) for x in cursor.split('-')]
+    except (AttributeError, ValueError):
+        return (None, 0)
+    return (epoch, version)
+
+
+def get_pokemarker_changes(cursor, bounds=None):
+    """
+    Markers changed since a cursor returned by an earlier call
+    :param cursor: cursor the client is up to date with, None or 0 for none
+    :param bounds: (south, west, north, east) to limit markers to, if any
+    :return: dict with the new cursor, inserted and updated markers and the
+             kind and key of expired ones. If the cursor is too old, reset is
+             set and inserted holds every marker.
+    """
+
+    (state, changes) = store.changes_since(parse_cursor(cursor))
+    if changes is None:
+        return {
+            'cursor': format_cursor(state),
+            'reset': True,
+            'inserted': get_pokemarkers(bounds),
+            'updated': [],
+            'expired': [],
+        }
+
+    delta = {
+        'cursor': format_cursor(state),
+        'reset': False,
+        'inserted': [],
+        'updated': [],
+        'expired': [],
+    }
+    for ((kind, key), (op, item)) in changes.iteritems():
+        if op == 'expired':
+            delta['expired'].append({'type': kind, 'key': key})
+            continue
+        marker = get_marker(kind, key, item)
+        if bounds is None or in_bounds(bounds, marker['lat'], marker['lng']):
+            delta[op].append(marker)
+    return delta
+
+
 def get_map():
+    # the page loads the markers of its viewport itself
     fullmap = Map(
         identifier="fullmap2",
         style='height:100%;width:100%;top:0;left:0;position:absolute;z-index:200;',
         lat=origin_lat,
         lng=origin_lon,
-        markers=get_pokemarkers(),
+        markers=[],
         zoom='15', )
     return fullmap
 
 
 if __name__ == '__main__':
     args = get_args()
-    register_background_thread(initial_registration=True)
-    app.run(debug=True, threaded=True, host=args.host, port=args.port)
+    service = main(args)
+    if service is not None and args.scan_only:
+        # the map is served by other processes, see serve()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            service.stop()
+    elif service is not None:
+        # the reloader would run a second scanner in its child process
+        app.run(debug=args.debug, use_reloader=False, threaded=True,
+                host=args.host, port=args.port)
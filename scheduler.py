@@ -0,0 +1,217 @@
+import heapq
+import threading
+import time
+
+HOUR = 3600
+# a pokemon stays for this long after its spawn point spawns it, and the spawn
+# point spawns again an hour after it did
+SPAWN_DURATION = 900
+# steps are rescanned at least this often regardless, to find new spawn points
+RESCAN_INTERVAL = 600
+# steps people are looking at are rescanned at least this often
+VIEWED_RESCAN_INTERVAL = 60
+# interest of viewers in a step halves every INTEREST_HALF_LIFE seconds, and
+# the step counts as viewed while it is above VIEWED_INTEREST
+INTEREST_HALF_LIFE = 300
+VIEWED_INTEREST = 0.5
+# score boost per spawn point of a step and per unit of interest in it
+DENSITY_WEIGHT = 0.1
+INTEREST_WEIGHT = 1.0
+
+
+def get_spawn_second(disappear_time):
+    """
+    Second of the hour a spawn point spawns at, from the disappear time of a
+    pokemon it spawned
+    """
+
+    return int(disappear_time - SPAWN_DURATION) % HOUR
+
+
+def decay(value, since, now):
+    return value * 0.5 ** ((now - since) / float(INTEREST_HALF_LIFE))
+
+
+def spawned_between(spawn_second, since, until):
+    """
+    Whether a spawn point spawning at spawn_second past every hour has spawned
+    in the interval (since, until]
+    """
+
+    return (until - spawn_second) // HOUR > (since - spawn_second) // HOUR
+
+
+class SpawnSchedule(object):
+    """
+    Learns when the spawn points covered by each step of a scan plan spawn,
+    from the pokemons seen there, and tells which steps are due: those that
+    were never scanned, those that were not for rescan_interval seconds, and
+    those with a spawn point that has spawned since their last scan. Steps
+    with nothing spawning are left alone in between.
+    Steps people are looking at are due every VIEWED_RESCAN_INTERVAL as well.
+    Due steps are handed out through a ScanQueue, stalest, densest and most
+    viewed first.
+    Steps are referred to by their index in the plan.
+    """
+
+    def __init__(self, step_count, rescan_interval=RESCAN_INTERVAL):
+        self.lock = threading.Lock()
+        self.rescan_interval = rescan_interval
+        self.spawn_points = {}  # spawn point id: index of the step seeing it
+        # per step, spawn point id: second of the hour it spawns at
+        self.step_spawns = [{} for _ in xrange(step_count)]
+        self.last_scanned = [None] * step_count
+        # per step, (interest, time it was last updated)
+        self.interest = [(0.0, 0)] * step_count
+        self.queue = None
+
+    def record(self, step, spawn_point_id, time_till_hidden, now=None):
+        """
+        Learn the timing of a spawn point from a pokemon seen at it
+        :param step: index of the step the pokemon was seen from
+        :param time_till_hidden: seconds until the pokemon disappears
+        """
+
+        if not 0 < time_till_hidden <= HOUR:
+            return
+        if now is None:
+            now = time.time()
+        second = get_spawn_second(now + time_till_hidden)
+        with self.lock:
+            # steps overlap, the first one to see a spawn point scans it
+            step = self.spawn_points.setdefault(spawn_point_id, step)
+            self.step_spawns[step][spawn_point_id] = second
+
+    def mark_scanned(self, step, now):
+        """
+        :param now: time the scan of the step started
+        """
+
+        with self.lock:
+            self.last_scanned[step] = now
+
+    def add_interest(self, steps, now=None, weight=1.0):
+        """
+        Note that viewers asked about some steps, raising their score in the
+        current queue as well
+        :param steps: indexes of the steps
+        """
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for step in steps:
+                (interest, since) = self.interest[step]
+                self.interest[step] = (decay(interest, since, now) + weight,
+                                       now)
+            queue = self.queue
+        if queue is not None:
+            for step in steps:
+                queue.update(step, self.get_score(step, now))
+
+    def _get_interest(self, step, now):
+        (interest, since) = self.interest[step]
+        return decay(interest, since, now)
+
+    def get_score(self, step, now):
+        """
+        Priority of a step: seconds since its last scan, up to rescan_interval,
+        raised by the number of its spawn points and by viewer interest
+        """
+
+        with self.lock:
+            last = self.last_scanned[step]
+            if last is None:
+                staleness = self.rescan_interval
+            else:
+                staleness = min(now - last, self.rescan_interval)
+            return (staleness *
+                    (1 + DENSITY_WEIGHT * len(self.step_spawns[step])) *
+                    (1 + INTEREST_WEIGHT * self._get_interest(step, now)))
+
+    def is_due(self, step, now):
+        with self.lock:
+            last = self.last_scanned[step]
+            if last is None or now - last >= self.rescan_interval:
+                return True
+            if (now - last >= VIEWED_RESCAN_INTERVAL and
+                    self._get_interest(step, now) >= VIEWED_INTEREST):
+                return True
+            return any(spawned_between(second, last, now)
+                       for second in self.step_spawns[step].itervalues())
+
+    def get_due(self, now=None):
+        """
+        :return: indexes of the steps due for a scan, in plan order
+        """
+
+        if now is None:
+            now = time.time()
+        return [step for step in xrange(len(self.last_scanned))
+                if self.is_due(step, now)]
+
+    def get_queue(self, now=None):
+        """
+        Queue of the steps due now, which interest added while it is worked
+        through reorders
+        :return: ScanQueue
+        """
+
+        if now is None:
+            now = time.time()
+        queue = ScanQueue()
+        for step in self.get_due(now):
+            queue.push(step, self.get_score(step, now))
+        with self.lock:
+            self.queue = queue
+        return queue
+
+    def get_spawn_point_count(self):
+        with self.lock:
+            return len(self.spawn_points)
+
+
+class ScanQueue(object):
+    """
+    Thread-safe priority queue of steps, highest score first, ties in plan
+    order. A step's score can be raised while it is queued; outdated entries
+    are skipped when they come up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.scores = {}  # step: latest score, for the steps still queued
+
+    def push(self, step, score):
+        with self.lock:
+            self.scores[step] = score
+            heapq.heappush(self.heap, (-score, step))
+
+    def update(self, step, score):
+        """
+        Requeue a step with a new score, if it is still queued
+        """
+
+        with self.lock:
+            if self.scores.get(step, score) == score:
+                return
+            self.scores[step] = score
+            heapq.heappush(self.heap, (-score, step))
+
+    def pop(self):
+        """
+        :return: index of the highest scoring step, None once the queue is empty
+        """
+
+        with self.lock:
+            while self.heap:
+                (score, step) = heapq.heappop(self.heap)
+                if self.scores.get(step) == -score:
+                    del self.scores[step]
+                    return step
+            return None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.scores)
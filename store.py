@@ -0,0 +1,842 @@
+import bisect
+import heapq
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from s2sphere import CellId, LatLng, LatLngRect, RegionCoverer
+
+CELL_LEVEL = 15
+COVERING_CELLS = 8
+# clusters are maintained for S2 levels 0 up to this one
+CLUSTER_LEVEL = 13
+CHANGE_LOG_SIZE = 10000
+# rescans report the disappear_time of a pokemon with some jitter
+DISAPPEAR_TIME_TOLERANCE = 1.0
+# seconds between checks for a new snapshot file
+SNAPSHOT_POLL_INTERVAL = 1.0
+# least seconds between two writes of the snapshot file
+SNAPSHOT_WRITE_INTERVAL = 1.0
+# changes every snapshot carries, plenty for followers checking for a new
+# one every SNAPSHOT_POLL_INTERVAL to keep their change log whole
+SNAPSHOT_CHANGE_LOG_SIZE = 1000
+
+
+def to_signed(cell_id):
+    """
+    SQLite integers are signed 64-bit, S2 cell IDs are unsigned. Descendants
+    of a cell never straddle a face, so ranges stay contiguous once converted.
+    """
+    if cell_id >= 1 << 63:
+        return cell_id - (1 << 64)
+    return cell_id
+
+
+def get_cell_id(lat, lng):
+    return to_signed(CellId.from_lat_lng(LatLng.from_degrees(
+        lat, lng)).parent(CELL_LEVEL).id())
+
+
+def get_cell_range(cell_id):
+    cell = CellId(cell_id)
+    return (to_signed(cell.range_min().id()), to_signed(cell.range_max().id()))
+
+
+def get_leaf_id(lat, lng):
+    return CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).id()
+
+
+def get_parent_id(leaf_id, level):
+    lsb = 1 << (2 * (30 - level))
+    return (leaf_id & -lsb) | lsb
+
+
+def get_location(kind, item):
+    if kind == 'pokemon':
+        return (item['lat'], item['lng'])
+    if kind == 'gym':
+        return (item[1], item[2])
+    return (item[0], item[1])
+
+
+def get_covering_ranges(bounds):
+    """
+    Leaf cell ID ranges of a few S2 cells covering a lat/lng rectangle
+    :param bounds: (south, west, north, east) in degrees
+    :return: sorted list of (min, max) cell IDs
+    """
+
+    (south, west, north, east) = bounds
+    coverer = RegionCoverer()
+    coverer.max_cells = COVERING_CELLS
+    rect = LatLngRect(LatLng.from_degrees(south, west),
+                      LatLng.from_degrees(north, east))
+    return sorted((cell.range_min().id(), cell.range_max().id())
+                  for cell in coverer.get_covering(rect))
+
+
+def in_bounds(bounds, lat, lng):
+    """
+    Whether a location is inside (south, west, north, east) bounds; west being
+    greater than east means the bounds cross the antimeridian
+    """
+
+    (south, west, north, east) = bounds
+    if not south <= lat <= north:
+        return False
+    if west <= east:
+        return west <= lng <= east
+    return lng >= west or lng <= east
+
+
+def replace_file(src, dst):
+    """
+    os.rename, replacing dst on Windows as well, where this is not atomic
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def same_encounter(pokemon, other):
+    return (pokemon['id'] == other['id'] and
+            pokemon['lat'] == other['lat'] and
+            pokemon['lng'] == other['lng'] and
+            abs(pokemon['disappear_time'] - other['disappear_time']) <=
+            DISAPPEAR_TIME_TOLERANCE)
+
+
+class SqliteBackend(object):
+    """
+    Persists sightings to a SQLite database. Pokemon rows are kept after they
+    expire, so the database doubles as the sighting history.
+    """
+
+    SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pokemon (
+    spawn_point_id TEXT NOT NULL,
+    pokemon_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    cell_id INTEGER NOT NULL,
+    disappear_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pokemon_spawn_point
+    ON pokemon (spawn_point_id, disappear_time);
+CREATE INDEX IF NOT EXISTS pokemon_disappear_time
+    ON pokemon (disappear_time);
+CREATE INDEX IF NOT EXISTS pokemon_pokemon_id
+    ON pokemon (pokemon_id, disappear_time);
+CREATE INDEX IF NOT EXISTS pokemon_cell_id
+    ON pokemon (cell_id, disappear_time);
+CREATE TABLE IF NOT EXISTS gym (
+    fort_id TEXT PRIMARY KEY,
+    team INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    gym_points INTEGER NOT NULL,
+    cell_id INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS gym_cell_id ON gym (cell_id);
+CREATE TABLE IF NOT EXISTS pokestop (
+    fort_id TEXT PRIMARY KEY,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    lure_expiration,
+    cell_id INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pokestop_cell_id ON pokestop (cell_id);
+'''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def write(self, pokemons, gyms, pokestops, now):
+        """
+        Write one batch of sightings in a single transaction. A pokemon still
+        live at the same spawn point is the same encounter and is updated in
+        place, anything else becomes a new history row.
+        """
+
+        with self.lock, self.db:
+            for (key, pokemon) in pokemons.iteritems():
+                cursor = self.db.execute(
+                    'UPDATE pokemon SET lat = ?, lng = ?, disappear_time = ? '
+                    'WHERE spawn_point_id = ? AND pokemon_id = ? '
+                    'AND disappear_time > ?',
+                    (pokemon['lat'], pokemon['lng'],
+                     pokemon['disappear_time'], key, pokemon['id'], now))
+                if not cursor.rowcount:
+                    self.db.execute(
+                        'INSERT INTO pokemon VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (key, pokemon['id'], pokemon['name'], pokemon['lat'],
+                         pokemon['lng'],
+                         get_cell_id(pokemon['lat'], pokemon['lng']),
+                         pokemon['disappear_time']))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO gym VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(key, gym[0], gym[1], gym[2], gym[3],
+                  get_cell_id(gym[1], gym[2]), now)
+                 for (key, gym) in gyms.iteritems()])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO pokestop VALUES (?, ?, ?, ?, ?, ?)',
+                [(key, stop[0], stop[1], stop[2],
+                  get_cell_id(stop[0], stop[1]), now)
+                 for (key, stop) in pokestops.iteritems()])
+
+    def load(self, now):
+        """
+        Read back what is still live
+        :return: (pokemons, gyms, pokestops) dicts in SightingStore format
+        """
+
+        with self.lock:
+            pokemons = dict(
+                (row[0], {
+                    'id': row[1],
+                    'name': row[2],
+                    'lat': row[3],
+                    'lng': row[4],
+                    'disappear_time': row[5],
+                })
+                for row in self.db.execute(
+                    'SELECT spawn_point_id, pokemon_id, name, lat, lng, '
+                    'disappear_time FROM pokemon WHERE disappear_time > ? '
+                    'ORDER BY disappear_time', (now, )))
+            gyms = dict(
+                (row[0], list(row[1:]))
+                for row in self.db.execute(
+                    'SELECT fort_id, team, lat, lng, gym_points FROM gym'))
+            pokestops = dict(
+                (row[0], list(row[1:]))
+                for row in self.db.execute(
+                    'SELECT fort_id, lat, lng, lure_expiration FROM pokestop'))
+        return pokemons, gyms, pokestops
+
+    def query_pokemons(self, pokemon_id=None, since=None, until=None,
+                       cell_id=None, limit=1000):
+        clauses = []
+        params = []
+        if pokemon_id is not None:
+            clauses.append('pokemon_id = ?')
+            params.append(pokemon_id)
+        if since is not None:
+            clauses.append('disappear_time >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('disappear_time < ?')
+            params.append(until)
+        if cell_id is not None:
+            clauses.append('cell_id BETWEEN ? AND ?')
+            params.extend(get_cell_range(cell_id))
+        sql = ('SELECT spawn_point_id, pokemon_id, name, lat, lng, '
+               'disappear_time FROM pokemon')
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY disappear_time DESC LIMIT ?'
+        params.append(limit)
+
+        with self.lock:
+            return [{
+                'spawn_point_id': row[0],
+                'id': row[1],
+                'name': row[2],
+                'lat': row[3],
+                'lng': row[4],
+                'disappear_time': row[5],
+            } for row in self.db.execute(sql, params)]
+
+
+class Snapshot(object):
+    """
+    The sightings of a SightingStore as of one version. Neither a snapshot nor
+    the dicts and sightings in it are ever modified, a change to the store
+    publishes a new snapshot instead, so snapshots are read without locking.
+    They can be written to a file for another process to load, along with
+    the last changes of the store's change log, which leads up to version,
+    and the store's epoch.
+    """
+
+    def __init__(self, version=0, pokemons=None, gyms=None, pokestops=None,
+                 changes=None, epoch=0):
+        self.version = version
+        self.pokemons = pokemons or {}
+        self.gyms = gyms or {}
+        self.pokestops = pokestops or {}
+        self.changes = changes or []
+        self.epoch = epoch
+
+    def get_pokemons(self, now=None):
+        """
+        Pokemons that have not disappeared yet
+        """
+
+        if now is None:
+            now = time.time()
+        return dict((key, pokemon)
+                    for (key, pokemon) in self.pokemons.iteritems()
+                    if pokemon['disappear_time'] >= now)
+
+    def dump(self, path):
+        """
+        Write the snapshot to path as JSON, replacing the previous one
+        atomically. The file is only readable by its owner.
+        """
+
+        # a new file of a random name, which nobody else can have made
+        (fd, tmp_path) = tempfile.mkstemp(
+            prefix=os.path.basename(path) + '.', suffix='.tmp',
+            dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                # the epoch and version go first, on a line of their own, so
+                # that they can be read without the rest
+                json.dump([self.epoch, self.version], f)
+                f.write('\n')
+                json.dump([self.pokemons, self.gyms, self.pokestops,
+                           self.changes], f)
+            replace_file(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+def load_snapshot(path, known_state=None):
+    """
+    :param known_state: (epoch, version) not worth loading again
+    :return: Snapshot written by Snapshot.dump, None if it has known_state
+    """
+
+    with open(path) as f:
+        (epoch, version) = json.loads(f.readline())
+        if (epoch, version) == known_state:
+            return None
+        (pokemons, gyms, pokestops, changes) = json.loads(f.readline())
+    return Snapshot(version, pokemons, gyms, pokestops,
+                    [tuple(change) for change in changes], epoch)
+
+
+class SightingStore(object):
+    """
+    Pokemons, gyms and pokestops seen by the scanners. Pokemons are keyed by
+    spawn point ID and are dicts with lat, lng, disappear_time, id and name;
+    gyms are [team, lat, lng, gym points] and pokestops [lat, lng, lure
+    expiration], both keyed by fort ID. Live sightings are served from memory,
+    an optional backend persists every batch.
+
+    Pokemons are also kept in a min-heap of (disappear_time, key), so expiring
+    them only touches the ones that have actually disappeared. Entries whose
+    pokemon was updated since they were pushed are skipped when popped.
+
+    Every insert, update and expiry bumps the store version and is appended to
+    a bounded change log, so readers can ask for what changed since a version
+    they have already seen, or wait for the next change. Versions start over
+    with every store; its epoch, random, tells versions of different stores
+    apart.
+
+    Live sightings are indexed by the leaf S2 cell of their location in a
+    sorted list of (cell ID, kind, key), so a lat/lng rectangle maps to a few
+    contiguous slices of the index. They are also counted in clusters, one per
+    S2 cell of every level up to CLUSTER_LEVEL, kept up to date on every
+    change so that zoomed out maps can be served without visiting sightings.
+
+    Readers can cache values derived from a sighting, such as its rendered
+    marker, with the sighting itself; the cache is dropped whenever the
+    sighting changes or expires.
+
+    The first read of all sightings after a change publishes a new Snapshot,
+    which the reads after it share without copying; batches in between are
+    published together. Snapshots can also be written to a file, at most
+    every SNAPSHOT_WRITE_INTERVAL, which stores in other processes follow.
+    A follower takes over the sightings, version, change log and epoch of
+    every snapshot as they are, so that versions mean the same in every
+    process and cursors and ETags can be used with any of them. Followers
+    drop pokemons as they disappear without logging it; the expiries logged
+    by the store they follow come with its next snapshot.
+    """
+
+    def __init__(self, backend=None):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pokemons = {}
+        self.expiry = []
+        self.gyms = {}
+        self.pokestops = {}
+        self.version = 0
+        self.epoch = random.SystemRandom().getrandbits(32)
+        self.changes = []
+        self.index = []
+        self.leaf_ids = {}
+        self.rendered = {}
+        self.clusters = [{} for level in range(CLUSTER_LEVEL + 1)]
+        self.snapshot = Snapshot()
+        self.following = False
+        self.backend = None
+        if backend is not None:
+            self.set_backend(backend)
+
+    def set_backend(self, backend):
+        """
+        Start persisting to backend, after loading what it still has live
+        """
+
+        (pokemons, gyms, pokestops) = backend.load(time.time())
+        with self.lock:
+            self._add_pokemons(pokemons)
+            self._add_forts('gym', self.gyms, gyms)
+            self._add_forts('pokestop', self.pokestops, pokestops)
+            self.backend = backend
+
+    def set_snapshot_path(self, path, interval=SNAPSHOT_WRITE_INTERVAL):
+        """
+        Write a snapshot to path now, then again after changes, from a
+        background thread, at most every interval seconds
+        """
+
+        snapshot = self.get_snapshot()
+        snapshot.dump(path)
+
+        def write(version):
+            while True:
+                time.sleep(interval)
+                with self.lock:
+                    while self.version == version:
+                        self.changed.wait()
+                    self._publish()
+                    snapshot = self.snapshot
+                try:
+                    snapshot.dump(path)
+                    version = snapshot.version
+                except (IOError, OSError):
+                    # tried again after the next interval
+                    pass
+
+        thread = threading.Thread(target=write, args=(snapshot.version, ))
+        thread.daemon = True
+        thread.name = 'snapshot_writer'
+        thread.start()
+
+    def follow(self, path, interval=SNAPSHOT_POLL_INTERVAL):
+        """
+        Keep this store up to date with the snapshots another store writes to
+        path, from a background thread
+        """
+
+        def poll():
+            loaded = None
+            while True:
+                try:
+                    snapshot = load_snapshot(path, loaded)
+                    if snapshot is not None:
+                        self._adopt(snapshot)
+                        loaded = (snapshot.epoch, snapshot.version)
+                except (OSError, IOError, ValueError, TypeError):
+                    pass
+                time.sleep(interval)
+
+        self.following = True
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.name = 'snapshot_follower'
+        thread.start()
+
+    def add(self, pokemons=None, gyms=None, pokestops=None):
+        """
+        Record the sightings of one scan step as a single batch
+        :param pokemons: dict of spawn point ID to pokemon
+        :param gyms: dict of fort ID to gym
+        :param pokestops: dict of fort ID to pokestop
+        :return: None
+        """
+
+        pokemons = pokemons or {}
+        gyms = gyms or {}
+        pokestops = pokestops or {}
+        with self.lock:
+            self._add_pokemons(pokemons)
+            self._add_forts('gym', self.gyms, gyms)
+            self._add_forts('pokestop', self.pokestops, pokestops)
+            # expiries go out with the batch, to followers as well
+            self._expire(time.time())
+            self.changed.notify_all()
+        if self.backend is not None:
+            self.backend.write(pokemons, gyms, pokestops, time.time())
+
+    def _adopt(self, snapshot):
+        """
+        Make this store a copy of the one a snapshot was published by
+        """
+
+        with self.lock:
+            self._replace('pokemon', self.pokemons,
+                          snapshot.get_pokemons(time.time()))
+            self.expiry = [(pokemon['disappear_time'], key)
+                           for (key, pokemon) in self.pokemons.iteritems()]
+            heapq.heapify(self.expiry)
+            self._replace('gym', self.gyms, snapshot.gyms)
+            self._replace('pokestop', self.pokestops, snapshot.pokestops)
+            first = (snapshot.changes[0][0] if snapshot.changes
+                     else snapshot.version + 1)
+            if (snapshot.epoch == self.epoch and
+                    first <= self.version + 1 <= snapshot.version + 1):
+                self.changes.extend(change for change in snapshot.changes
+                                    if change[0] > self.version)
+                if len(self.changes) > 2 * CHANGE_LOG_SIZE:
+                    del self.changes[:-CHANGE_LOG_SIZE]
+            else:
+                # missed changes, or another store
+                self.changes = list(snapshot.changes)
+            self.epoch = snapshot.epoch
+            self.version = snapshot.version
+            self.snapshot = snapshot
+            self.changed.notify_all()
+
+    def _replace(self, kind, items, updates):
+        """
+        Make items, the sightings of a kind, the same as updates, without
+        logging the changes
+        """
+
+        for key in [key for key in items if key not in updates]:
+            self._reindex(kind, key, items.pop(key), None)
+        for (key, item) in updates.iteritems():
+            current = items.get(key)
+            if current != item:
+                self._reindex(kind, key, current, item)
+                items[key] = item
+
+    def _publish(self):
+        if self.snapshot.version != self.version:
+            self.snapshot = Snapshot(self.version, dict(self.pokemons),
+                                     dict(self.gyms), dict(self.pokestops),
+                                     self.changes[-SNAPSHOT_CHANGE_LOG_SIZE:],
+                                     self.epoch)
+
+    def _log(self, kind, key, op):
+        self.version += 1
+        self.changes.append((self.version, kind, key, op))
+        if len(self.changes) > 2 * CHANGE_LOG_SIZE:
+            del self.changes[:-CHANGE_LOG_SIZE]
+
+    def _add_pokemons(self, pokemons):
+        for (key, pokemon) in pokemons.iteritems():
+            current = self.pokemons.get(key)
+            if current is not None and same_encounter(current, pokemon):
+                continue
+            self._reindex('pokemon', key, current, pokemon)
+            self.pokemons[key] = pokemon
+            heapq.heappush(self.expiry, (pokemon['disappear_time'], key))
+            self._log('pokemon', key,
+                      'inserted' if current is None else 'updated')
+        # every rescan of a live pokemon pushes a new entry, drop the
+        # outdated ones before they outnumber the live pokemons
+        if len(self.expiry) > 2 * len(self.pokemons) + 64:
+            self.expiry = [(pokemon['disappear_time'], key)
+                           for (key, pokemon) in self.pokemons.iteritems()]
+            heapq.heapify(self.expiry)
+
+    def _add_forts(self, kind, forts, updates):
+        for (key, fort) in updates.iteritems():
+            current = forts.get(key)
+            if current == fort:
+                continue
+            self._reindex(kind, key, current, fort)
+            forts[key] = fort
+            self._log(kind, key, 'inserted' if current is None else 'updated')
+
+    def _expire(self, now):
+        removed = []
+        while self.expiry and self.expiry[0][0] < now:
+            (disappear_time, key) = heapq.heappop(self.expiry)
+            pokemon = self.pokemons.get(key)
+            if pokemon is not None and pokemon['disappear_time'] == disappear_time:
+                removed.append(self.pokemons.pop(key))
+                self._reindex('pokemon', key, pokemon, None)
+                if not self.following:
+                    self._log('pokemon', key, 'expired')
+        if removed and not self.following:
+            self.changed.notify_all()
+        return removed
+
+    def _reindex(self, kind, key, current, item):
+        """
+        Move a sighting in the cell index and clusters from its current state
+        to item; either can be None
+        """
+
+        self.rendered.pop((kind, key), None)
+        leaf_id = self.leaf_ids.pop((kind, key), None)
+        new_leaf_id = None
+        if item is not None:
+            location = get_location(kind, item)
+            if current is not None and get_location(kind, current) == location:
+                new_leaf_id = leaf_id
+            else:
+                new_leaf_id = get_leaf_id(*location)
+            self.leaf_ids[(kind, key)] = new_leaf_id
+
+        if leaf_id != new_leaf_id:
+            if leaf_id is not None:
+                entry = (leaf_id, kind, key)
+                i = bisect.bisect_left(self.index, entry)
+                if i < len(self.index) and self.index[i] == entry:
+                    del self.index[i]
+            if new_leaf_id is not None:
+                bisect.insort(self.index, (new_leaf_id, kind, key))
+
+        if leaf_id is not None:
+            self._cluster(leaf_id, kind, current, -1)
+        if new_leaf_id is not None:
+            self._cluster(new_leaf_id, kind, item, 1)
+
+    def _cluster(self, leaf_id, kind, item, sign):
+        (lat, lng) = get_location(kind, item)
+        for (level, clusters) in enumerate(self.clusters):
+            cell_id = get_parent_id(leaf_id, level)
+            cluster = clusters.get(cell_id)
+            if cluster is None:
+                cluster = clusters[cell_id] = {
+                    'count': 0,
+                    'lat_sum': 0.0,
+                    'lng_sum': 0.0,
+                    'pokemons': {},
+                    'gyms': 0,
+                    'pokestops': 0,
+                }
+            cluster['count'] += sign
+            if not cluster['count']:
+                del clusters[cell_id]
+                continue
+            cluster['lat_sum'] += sign * lat
+            cluster['lng_sum'] += sign * lng
+            if kind == 'pokemon':
+                counts = cluster['pokemons']
+                counts[item['id']] = counts.get(item['id'], 0) + sign
+                if not counts[item['id']]:
+                    del counts[item['id']]
+            elif kind == 'gym':
+                cluster['gyms'] += sign
+            else:
+                cluster['pokestops'] += sign
+
+    def _get(self, kind, key):
+        if kind == 'pokemon':
+            return self.pokemons.get(key)
+        if kind == 'gym':
+            return self.gyms.get(key)
+        return self.pokestops.get(key)
+
+    def get_snapshot(self):
+        """
+        Snapshot of the current version, published now if there is none yet;
+        its pokemons may include some that have disappeared since,
+        Snapshot.get_pokemons leaves those out
+        """
+
+        with self.lock:
+            self._publish()
+            return self.snapshot
+
+    def get_pokemons(self):
+        """
+        Live pokemons, from the latest snapshot. Callers must not modify them.
+        """
+
+        return self.get_snapshot().get_pokemons()
+
+    def get_gyms(self):
+        return self.get_snapshot().gyms
+
+    def get_pokestops(self):
+        return self.get_snapshot().pokestops
+
+    def get_state(self):
+        """
+        Current (epoch, version), after expiring anything that has
+        disappeared, so that two equal states always mean the same live
+        sightings
+        """
+
+        with self.lock:
+            self._expire(time.time())
+            return (self.epoch, self.version)
+
+    def wait(self, version, timeout=None):
+        """
+        Block until the store is past a version, or until timeout seconds have
+        passed
+        :return: current version
+        """
+
+        with self.lock:
+            if self.version <= version:
+                self.changed.wait(timeout)
+            return self.version
+
+    def get_rendered(self, kind, key, variant):
+        """
+        Value cached by set_rendered for a sighting, None if it changed since
+        """
+
+        with self.lock:
+            return self.rendered.get((kind, key), {}).get(variant)
+
+    def set_rendered(self, kind, key, item, variant, value):
+        """
+        Cache a value derived from a sighting, unless the sighting has changed
+        since item was read
+        :param item: the sighting, as read from this store
+        :param variant: anything hashable distinguishing values of a sighting
+        """
+
+        with self.lock:
+            if self._get(kind, key) is item:
+                self.rendered.setdefault((kind, key), {})[variant] = value
+
+    def changes_since(self, state):
+        """
+        Sightings changed after a given state, one entry per sighting
+        :param state: (epoch, version) returned by get_state or an earlier
+                      call, None for none
+        :return: (current state, changes) where changes maps (kind, key) to
+                 (op, item); kind is pokemon, gym or pokestop, op is inserted,
+                 updated or expired and item is None once expired. changes is
+                 None when the log does not reach back to state, or state is
+                 of another store, in which case the caller has to start over
+                 from a full read.
+        """
+
+        with self.lock:
+            self._expire(time.time())
+            current = (self.epoch, self.version)
+            if state is None or state[0] != self.epoch:
+                return (current, None)
+            version = state[1]
+            first = self.changes[0][0] if self.changes else self.version + 1
+            if version <= 0 or version > self.version or version < first - 1:
+                return (current, None)
+
+            ops = {}
+            for (_, kind, key, op) in self.changes[version - first + 1:]:
+                # an insert followed by updates is still new to the reader
+                if op == 'updated' and ops.get((kind, key)) == 'inserted':
+                    continue
+                ops[(kind, key)] = op
+            changes = {}
+            for (change, op) in ops.iteritems():
+                item = None if op == 'expired' else self._get(*change)
+                # followers drop pokemons ahead of the expiries they log
+                if item is None:
+                    op = 'expired'
+                changes[change] = (op, item)
+            return (current, changes)
+
+    def get_in_bounds(self, bounds):
+        """
+        Live sightings inside a lat/lng rectangle, in time proportional to the
+        number of sightings around it
+        :param bounds: (south, west, north, east) in degrees
+        :return: (pokemons, gyms, pokestops) dicts
+        """
+
+        ranges = get_covering_ranges(bounds)
+        found = {'pokemon': {}, 'gym': {}, 'pokestop': {}}
+        with self.lock:
+            self._expire(time.time())
+            for (cell_min, cell_max) in ranges:
+                i = bisect.bisect_left(self.index, (cell_min, ))
+                while i < len(self.index) and self.index[i][0] <= cell_max:
+                    (_, kind, key) = self.index[i]
+                    item = self._get(kind, key)
+                    if in_bounds(bounds, *get_location(kind, item)):
+                        found[kind][key] = item
+                    i += 1
+        return (found['pokemon'], found['gym'], found['pokestop'])
+
+    def get_clusters(self, level, bounds=None):
+        """
+        Sighting counts per S2 cell of a level
+        :param level: S2 level, at most CLUSTER_LEVEL
+        :param bounds: (south, west, north, east) the cluster centers must be
+                       in, if any
+        :return: list of dicts with the cell_id, the lat and lng of the
+                 center of the sightings, their count, the count per pokedex
+                 number as pokemons and the gyms and pokestops counts
+        """
+
+        found = []
+        with self.lock:
+            self._expire(time.time())
+            for (cell_id, cluster) in self.clusters[level].iteritems():
+                lat = cluster['lat_sum'] / cluster['count']
+                lng = cluster['lng_sum'] / cluster['count']
+                if bounds is not None and not in_bounds(bounds, lat, lng):
+                    continue
+                found.append({
+                    'cell_id': cell_id,
+                    'lat': lat,
+                    'lng': lng,
+                    'count': cluster['count'],
+                    'pokemons': dict(cluster['pokemons']),
+                    'gyms': cluster['gyms'],
+                    'pokestops': cluster['pokestops'],
+                })
+        return found
+
+    def clear_stale_pokemons(self, now=None):
+        """
+        Forget pokemons that have disappeared. The backend keeps them.
+        :return: list of removed pokemons
+        """
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return self._expire(now)
+
+    def query_pokemons(self, pokemon_id=None, since=None, until=None,
+                       cell_id=None, limit=1000):
+        """
+        Sightings matching all given filters, latest disappear_time first.
+        Without a backend only live pokemons can be found.
+        :param pokemon_id: pokedex number
+        :param since: earliest disappear_time, as a timestamp
+        :param until: disappear_time upper bound (exclusive), as a timestamp
+        :param cell_id: S2 cell ID, of level 15 or lower, sightings must be in
+        :param limit: maximum number of sightings returned
+        :return: list of pokemon dicts, with an extra spawn_point_id
+        """
+
+        if self.backend is not None:
+            return self.backend.query_pokemons(pokemon_id, since, until,
+                                               cell_id, limit)
+
+        if cell_id is not None:
+            (cell_min, cell_max) = get_cell_range(cell_id)
+        matches = []
+        for (key, pokemon) in self.get_pokemons().iteritems():
+            if pokemon_id is not None and pokemon['id'] != pokemon_id:
+                continue
+            if since is not None and pokemon['disappear_time'] < since:
+                continue
+            if until is not None and pokemon['disappear_time'] >= until:
+                continue
+            if cell_id is not None and not (
+                    cell_min <= get_cell_id(pokemon['lat'],
+                                            pokemon['lng']) <= cell_max):
+                continue
+            match = dict(pokemon)
+            match['spawn_point_id'] = key
+            matches.append(match)
+        matches.sort(key=lambda pokemon: pokemon['disappear_time'],
+                     reverse=True)
+        return matches[:limit]
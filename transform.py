@@ -1,5 +1,10 @@
 from math import sqrt, sin, cos
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
@@ -24,6 +29,40 @@ def transform_from_wgs_to_gcj(wgs_loc):
     return adjust_loc.latitude, adjust_loc.longitude
 
 
+def transform_batch_from_wgs_to_gcj(latitudes, longitudes):
+    """
+    transform_from_wgs_to_gcj for many locations at once, in one vectorized
+    pass when NumPy is installed and one location at a time otherwise
+    :param latitudes: sequence or array of WGS-84 latitudes
+    :param longitudes: sequence or array of WGS-84 longitudes, as many
+    :return: (latitudes, longitudes) arrays, or lists without NumPy
+    """
+
+    if numpy is None:
+        adjusted = [transform_from_wgs_to_gcj(Location(lat, lng))
+                    for (lat, lng) in zip(latitudes, longitudes)]
+        return ([lat for (lat, lng) in adjusted],
+                [lng for (lat, lng) in adjusted])
+
+    latitudes = numpy.array(latitudes, dtype=numpy.float64)
+    longitudes = numpy.array(longitudes, dtype=numpy.float64)
+    inside = ~((longitudes < 72.004) | (longitudes > 137.8347) |
+               (latitudes < 0.8293) | (latitudes > 55.8271))
+    lat = latitudes[inside]
+    lng = longitudes[inside]
+    adjust_lat = transform_lat_array(lng - 105, lat - 35.0)
+    adjust_lon = transform_long_array(lng - 105, lat - 35.0)
+    rad_lat = lat / 180.0 * pi
+    magic = numpy.sin(rad_lat)
+    magic = 1 - ee * magic * magic
+    sqrt_magic = numpy.sqrt(magic)
+    adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * sqrt_magic) * pi)
+    adjust_lon = (adjust_lon * 180.0) / (a / sqrt_magic * numpy.cos(rad_lat) * pi)
+    latitudes[inside] += adjust_lat
+    longitudes[inside] += adjust_lon
+    return latitudes, longitudes
+
+
 def is_location_out_of_china(wgs):
     if wgs.longitude < 72.004 or wgs.longitude > 137.8347 or wgs.latitude < 0.8293 or wgs.latitude > 55.8271:
         return True
@@ -46,6 +85,24 @@ def transform_long(x, y):
     return lon
 
 
+def transform_lat_array(x, y):
+    sin = numpy.sin
+    lat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * numpy.sqrt(numpy.abs(x))
+    lat += (20.0 * sin(6.0 * x * pi) + 20.0 * sin(2.0 * x * pi)) * 2.0 / 3.0
+    lat += (20.0 * sin(y * pi) + 40.0 * sin(y / 3.0 * pi)) * 2.0 / 3.0
+    lat += (160.0 * sin(y / 12.0 * pi) + 320 * sin(y * pi / 30.0)) * 2.0 / 3.0
+    return lat
+
+
+def transform_long_array(x, y):
+    sin = numpy.sin
+    lon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * numpy.sqrt(numpy.abs(x))
+    lon += (20.0 * sin(6.0 * x * pi) + 20.0 * sin(2.0 * x * pi)) * 2.0 / 3.0
+    lon += (20.0 * sin(x * pi) + 40.0 * sin(x / 3.0 * pi)) * 2.0 / 3.0
+    lon += (150.0 * sin(x / 12.0 * pi) + 300.0 * sin(x / 30.0 * pi)) * 2.0 / 3.0
+    return lon
+
+
 class Location:
     def __init__(self, latitude, longitude):
         self.latitude = latitude
@@ -0,0 +1,30 @@
+"""
+WSGI entry point, for serving the map from several processes while the
+scanner runs on its own:
+
+    mkdir -m 700 ~/pogomap
+    python example.py -u USER -l LOCATION -st 10 --scan-only -sp ~/pogomap/snapshot
+    POGOMAP_ARGS="-u USER -l LOCATION -st 10 -sp $HOME/pogomap/snapshot" \
+        gunicorn --workers 4 --worker-class gevent wsgi:app
+
+POGOMAP_ARGS takes the scanner's arguments; web server processes only use
+the ones that change how the map is shown. /stream holds a worker thread for
+as long as a map is open, so use an asynchronous worker class such as gevent.
+With threaded workers, set --max-streams below the number of threads per
+worker, so that other requests still get a thread; maps beyond it poll.
+Every process follows the snapshots with a thread of its own, which does not
+survive a fork, so do not preload the app.
+
+Keep the snapshot in a directory only the user running the scanner and the
+web server can write to, not in a shared one such as /tmp, or other users can
+feed the map sightings of their own.
+"""
+
+import os
+import shlex
+
+import example
+
+example.serve(example.get_args(shlex.split(os.environ.get('POGOMAP_ARGS',
+                                                         ''))))
+app = example.app